@@ -0,0 +1,132 @@
+import re
+from typing import Optional
+
+# Words, phrases and emoji that settle an approval-channel reply on their own. Conversational words
+# ("ok", "yes", "no") are left out: "ok I will look at this tomorrow" and "no problem" aren't verdicts.
+APPROVE_PHRASES = {
+    "approved", "approve", "approving", "lgtm", "looks good", "looks good to me", "accepted", "accept",
+    "granted", "go ahead", "good to go", "ship it", "reimbursed",
+}
+DENY_PHRASES = {
+    "denied", "deny", "denying", "rejected", "reject", "declined", "decline", "refused",
+}
+NEGATIONS = {"not", "don't", "dont", "can't", "cant", "cannot", "won't", "wont", "isn't", "isnt", "never"}
+# Pleasantries a reply may carry next to its verdict and still count as nothing but the verdict
+COURTESIES = {"thanks", "thank", "you", "thx", "ty", "cheers"}
+# Acknowledgement emoji (👍, 👌, 🎉) are left out, since they often just mean "seen it"
+APPROVE_EMOJI = {
+    "white_check_mark", "heavy_check_mark", "ballot_box_with_check", "moneybag", "money_with_wings",
+    "✅", "✔️", "☑️",
+}
+DENY_EMOJI = {
+    "x", "no_entry", "no_entry_sign", "-1", "thumbsdown", "heavy_multiplication_x", "negative_squared_cross_mark",
+    "❌", "⛔", "🚫", "👎", "✖️", "❎",
+}
+
+APPROVED_MESSAGE = "Good news! Your reimbursement request has been approved. 🎉"
+DENIED_MESSAGE = ("Unfortunately your reimbursement request was denied. "
+                  "Please reach out in the reimbursements channel if you have any questions.")
+
+_EMOJI_CODE = re.compile(r":([a-z0-9_+\-]+)(?:::skin-tone-\d)?:")
+_WORD = re.compile(r"[a-z0-9'+\-]+")
+
+
+class ApprovalClassifier:
+    """
+    Deterministic classifier for replies in the approval channel.
+    Settles replies that are nothing but a verdict ("approved", "lgtm!", "denied", ✅) locally and
+    leaves anything else, including a verdict with a reason, to the LLM. Counts how often the fast
+    path is taken.
+    """
+
+    def __init__(self, max_words: int = 8):
+        """
+        Args:
+            max_words: Longer replies are always left to the LLM, since they may carry conditions
+        """
+        self.max_words = max_words
+        self.fast_hits = 0
+        self.fallbacks = 0
+
+    @staticmethod
+    def _emoji_verdict(name: str) -> Optional[bool]:
+        name = name.split("::")[0]
+        if name in APPROVE_EMOJI:
+            return True
+        if name in DENY_EMOJI:
+            return False
+        return None
+
+    def _verdict(self, text: str) -> Optional[bool]:
+        text = text.strip().lower()
+        if not text or "?" in text:
+            return None
+
+        verdicts = set()
+        for name in _EMOJI_CODE.findall(text):
+            verdicts.add(self._emoji_verdict(name))
+        for char in APPROVE_EMOJI | DENY_EMOJI:
+            if not char.isascii() and char in text:
+                verdicts.add(self._emoji_verdict(char))
+
+        words = _WORD.findall(_EMOJI_CODE.sub(" ", text))
+        if len(words) > self.max_words:
+            return None
+        # Every word has to be part of a verdict phrase, a negation of one, or a pleasantry
+        i = 0
+        while i < len(words):
+            if words[i] in COURTESIES:
+                i += 1
+                continue
+            negated = words[i] in NEGATIONS
+            start = i + 1 if negated else i
+            for n in (4, 3, 2, 1):
+                phrase = " ".join(words[start:start + n])
+                if start + n <= len(words) and (phrase in APPROVE_PHRASES or phrase in DENY_PHRASES):
+                    verdicts.add((phrase in APPROVE_PHRASES) != negated)
+                    i = start + n
+                    break
+            else:
+                # Anything else (a reason, a question, small talk) is for the LLM to read
+                return None
+
+        verdicts.discard(None)
+        # Nothing recognised, or mixed signals ("no problem, approved")
+        if len(verdicts) != 1:
+            return None
+        return verdicts.pop()
+
+    def classify(self, text: str) -> Optional[dict]:
+        """
+        Returns:
+            A read_response()-shaped dict ({"relevant", "approved", "message"}) when the reply is clear,
+            otherwise None
+        """
+        verdict = self._verdict(text)
+        if verdict is None:
+            self.fallbacks += 1
+            return None
+        self.fast_hits += 1
+        return {"relevant": True, "approved": verdict, "message": APPROVED_MESSAGE if verdict else DENIED_MESSAGE}
+
+    def classify_reaction(self, reaction: str) -> Optional[dict]:
+        """
+        Like classify(), for a Slack reaction name such as "white_check_mark" or "+1::skin-tone-3".
+        Reactions never fall back to the LLM, so unrecognised ones don't count against the hit rate.
+        """
+        verdict = self._emoji_verdict(reaction)
+        if verdict is None:
+            return None
+        self.fast_hits += 1
+        return {"relevant": True, "approved": verdict, "message": APPROVED_MESSAGE if verdict else DENIED_MESSAGE}
+
+    def stats(self) -> dict:
+        total = self.fast_hits + self.fallbacks
+        return {
+            "fast_hits": self.fast_hits,
+            "fallbacks": self.fallbacks,
+            "fast_path_rate": self.fast_hits / total if total else 0.0,
+        }
+
+
+classifier = ApprovalClassifier()
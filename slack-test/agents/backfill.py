@@ -0,0 +1,270 @@
+"""
+Bulk OCR of a folder of receipts, outside Slack.
+
+    python -m agents.backfill downloads/ --out backfill.jsonl --csv backfill.csv
+
+Pipeline mode (the default) reads images with bounded concurrency through the same cached OCR path the
+bot uses. Batch mode submits them with the Message Batches API instead, which is cheaper for large
+folders but can take a while to finish.
+
+Each result is appended to the JSONL file as soon as it is known, with the file name and the fields of
+prompts/ocr.txt. That file is also the checkpoint: rerunning the same command skips files that already
+have a result and retries the ones that failed. Batch mode also records its submitted batches in
+<out>.batches.json, so an interrupted run collects them instead of submitting the files again.
+
+Point --base-url (or ANTHROPIC_BASE_URL) at a local stand-in to run without the real API.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import anthropic
+
+from agents import ocr
+from agents.pages import extract_receipt
+from agents.prescreen import prescreen
+from agents.prompts import registry
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tif", ".tiff"}
+PDF_SUFFIX = ".pdf"
+CSV_FIELDS = ["file", "is_receipt", "too_blurry", "store_name", "date", "location", "total", "items", "error"]
+
+
+def scan(directory) -> List[Path]:
+    """Every image and PDF under directory, in a stable order."""
+    return sorted(path for path in Path(directory).rglob("*")
+                  if path.is_file() and (path.suffix.lower() in IMAGE_SUFFIXES or path.suffix.lower() == PDF_SUFFIX))
+
+
+class Checkpoint:
+    """The results JSONL, doubling as the record of which files are finished."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        # Format: {file: record} for files with a successful result
+        self.done: Dict[str, dict] = {}
+        text = ""
+        if self.path.exists():
+            text = self.path.read_text(encoding="utf-8")
+            for line in text.splitlines():
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Cut off by an interrupted run; the file is simply done again
+                    continue
+                if "error" in record:
+                    self.done.pop(record["file"], None)
+                else:
+                    self.done[record["file"]] = record
+        self._file = open(self.path, "a", encoding="utf-8")
+        if text and not text.endswith("\n"):
+            self._file.write("\n")
+
+    def is_done(self, name: str) -> bool:
+        return name in self.done
+
+    def write(self, name: str, result: Optional[dict] = None, error: Optional[str] = None):
+        record = {"file": name, "error": error} if error is not None else {"file": name, **result}
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        if error is None:
+            self.done[name] = record
+        print(f"{name}: {'failed (' + error + ')' if error is not None else 'done'}")
+
+    def close(self):
+        self._file.close()
+
+
+async def run_pipeline(root: Path, files: List[Path], checkpoint: Checkpoint, concurrency: int, client=None):
+    """
+    OCR files with up to concurrency in flight (and at most OCR_CONCURRENCY vision calls).
+    Each PDF is read as one multi-page receipt.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    for path in files:
+        queue.put_nowait(path)
+
+    async def work():
+        while not queue.empty():
+            path = queue.get_nowait()
+            name = path.relative_to(root).as_posix()
+            try:
+                if path.suffix.lower() == PDF_SUFFIX:
+                    result, _ = await extract_receipt([path], client=client)
+                else:
+                    result, _ = await ocr.extract_text_cached(path, client=client)
+                checkpoint.write(name, result)
+            except Exception as e:
+                checkpoint.write(name, error=repr(e))
+
+    await asyncio.gather(*(work() for _ in range(concurrency)))
+
+
+def _read_state(path: Path) -> dict:
+    return json.loads(path.read_text()) if path.exists() else {}
+
+
+def _write_state(path: Path, state: dict):
+    temp = path.with_suffix(".tmp")
+    temp.write_text(json.dumps(state))
+    os.replace(temp, path)
+
+
+async def run_batches(root: Path, files: List[Path], checkpoint: Checkpoint, client,
+                      batch_size: int = 100, poll_interval: float = 30.0):
+    """
+    OCR files through the Message Batches API.
+
+    Images already in the OCR cache, or rejected by the pre-screen, are answered without a request.
+    Identical images are sent once. Batches are polled every poll_interval seconds until all are collected.
+    PDFs need their pages merged, so they go through run_pipeline instead.
+    """
+    state_path = Path(f"{checkpoint.path}.batches.json")
+    # Format: {batch_id: {custom_id: [file, ...]}}. The custom_id is the image's cache key.
+    state = _read_state(state_path)
+    submitted = {name for requests in state.values() for names in requests.values() for name in names}
+
+    # Format: {cache key: (path, [file, ...])}
+    to_submit: Dict[str, tuple] = {}
+    pdfs = []
+    for path in files:
+        name = path.relative_to(root).as_posix()
+        if name in submitted:
+            continue
+        if path.suffix.lower() == PDF_SUFFIX:
+            pdfs.append(path)
+            continue
+        raw = path.read_bytes()
+        key = ocr.cache.key_for(raw)
+        try:
+            result = ocr.cache.get(key) or prescreen(raw)
+        except Exception as e:
+            checkpoint.write(name, error=repr(e))
+            continue
+        if result is not None:
+            checkpoint.write(name, result)
+        elif key in to_submit:
+            to_submit[key][1].append(name)
+        else:
+            to_submit[key] = (path, [name])
+
+    if pdfs:
+        await run_pipeline(root, pdfs, checkpoint, ocr.OCR_CONCURRENCY, client)
+
+    keys = list(to_submit)
+    for start in range(0, len(keys), batch_size):
+        chunk = keys[start:start + batch_size]
+        requests = [{"custom_id": key, "params": ocr.build_request(to_submit[key][0])} for key in chunk]
+        batch = await client.messages.batches.create(requests=requests)
+        state[batch.id] = {key: to_submit[key][1] for key in chunk}
+        _write_state(state_path, state)
+        print(f"Submitted batch {batch.id} with {len(chunk)} images")
+
+    while state:
+        for batch_id in list(state):
+            batch = await client.messages.batches.retrieve(batch_id)
+            if batch.processing_status != "ended":
+                continue
+            async for entry in await client.messages.batches.results(batch_id):
+                names = state[batch_id].get(entry.custom_id, [])
+                if entry.result.type != "succeeded":
+                    for name in names:
+                        checkpoint.write(name, error=entry.result.type)
+                    continue
+                message = entry.result.message
+                registry.record_usage("ocr", message.usage)
+                try:
+                    result = json.loads(message.content[0].text)
+                except json.JSONDecodeError as e:
+                    for name in names:
+                        checkpoint.write(name, error=repr(e))
+                    continue
+                ocr.cache.put(entry.custom_id, result)
+                for name in names:
+                    checkpoint.write(name, result)
+            del state[batch_id]
+            _write_state(state_path, state)
+        if state:
+            print(f"Waiting on {len(state)} batches")
+            await asyncio.sleep(poll_interval)
+    state_path.unlink(missing_ok=True)
+
+
+def write_csv(jsonl_path, csv_path):
+    """Flatten the latest record of every file in the results JSONL into a CSV."""
+    records: Dict[str, dict] = {}
+    with open(jsonl_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records[record["file"]] = record
+    with open(csv_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        for name in sorted(records):
+            row = dict(records[name])
+            if "items" in row:
+                row["items"] = json.dumps(row["items"], ensure_ascii=False)
+            writer.writerow(row)
+
+
+async def backfill(directory, out: str, mode: str = "pipeline", concurrency: int = ocr.OCR_CONCURRENCY,
+                   batch_size: int = 100, poll_interval: float = 30.0, client=None) -> dict:
+    """
+    OCR every image under directory that doesn't have a result in out yet.
+
+    Args:
+        client: AsyncAnthropic client, defaults to the OCR module's client
+
+    Returns:
+        dict with the number of files found, skipped as already done, and finished by this run
+    """
+    root = Path(directory)
+    files = scan(root)
+    checkpoint = Checkpoint(out)
+    todo = [path for path in files if not checkpoint.is_done(path.relative_to(root).as_posix())]
+    print(f"{len(files)} images found, {len(files) - len(todo)} already done")
+    done_before = len(checkpoint.done)
+    try:
+        if mode == "batch":
+            await run_batches(root, todo, checkpoint, client or ocr.async_client, batch_size, poll_interval)
+        else:
+            await run_pipeline(root, todo, checkpoint, concurrency, client)
+    finally:
+        checkpoint.close()
+    return {"found": len(files), "skipped": len(files) - len(todo), "finished": len(checkpoint.done) - done_before,
+            "failed": len(todo) - (len(checkpoint.done) - done_before)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m agents.backfill", description="OCR a folder of receipts.")
+    parser.add_argument("directory", help="Folder to scan for receipt images, e.g. downloads/")
+    parser.add_argument("--out", default="backfill.jsonl", help="Results JSONL, also used to resume")
+    parser.add_argument("--csv", help="Also write the results to this CSV file")
+    parser.add_argument("--mode", choices=("pipeline", "batch"), default="pipeline")
+    parser.add_argument("--concurrency", type=int, default=ocr.OCR_CONCURRENCY, help="Files in flight in pipeline mode")
+    parser.add_argument("--batch-size", type=int, default=100, help="Images per Message Batches request")
+    parser.add_argument("--poll-interval", type=float, default=30.0, help="Seconds between batch status checks")
+    parser.add_argument("--base-url", help="API base URL, e.g. a local stand-in for testing")
+    args = parser.parse_args(argv)
+
+    if not Path(args.directory).is_dir():
+        sys.exit(f"{args.directory} is not a directory")
+    client = anthropic.AsyncAnthropic(base_url=args.base_url) if args.base_url else None
+    report = asyncio.run(backfill(args.directory, args.out, args.mode, args.concurrency,
+                                  args.batch_size, args.poll_interval, client))
+    if args.csv:
+        write_csv(args.out, args.csv)
+    print(f"found: {report['found']}, already done: {report['skipped']}, "
+          f"finished: {report['finished']}, failed: {report['failed']}")
+
+
+if __name__ == "__main__":
+    main()
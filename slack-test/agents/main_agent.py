@@ -9,13 +9,23 @@ from claude_agent_sdk import (
     AssistantMessage, 
     TextBlock, 
     ResultMessage,
+    StreamEvent,
     UserMessage
 )
 import json
 from pathlib import Path
+from typing import Callable, Optional
 
 from pydantic.type_adapter import R
-from agents.ocr import extract_text
+from agents.pages import extract_receipt
+from agents.ocr import cache as ocr_cache
+from agents.memory import ConversationMemory
+from agents.pool import AgentPool
+from agents.approval import classifier
+from agents.request_template import render_request
+from agents.phase2 import PHASE2_INSTRUCTION, parse_phase2_reply, partial_message
+from agents import telemetry
+from agents.prompts import registry
 
 # Suppress ResourceWarnings from anyio streams in claude-agent-sdk
 # These are internal to the SDK and are cleaned up during garbage collection
@@ -24,170 +34,235 @@ warnings.filterwarnings("ignore", category=ResourceWarning, module="anyio")
 # Load environment variables from .env file
 load_dotenv()
 
+# Token budget for the conversation history sent with each agent query
+MEMORY_MAX_TOKENS = int(os.getenv("MEMORY_MAX_TOKENS", "3000"))
+
+# Session states. Transitions only go forward: AWAITING_RECEIPT -> COLLECTING_INFO -> SUBMITTED
+AWAITING_RECEIPT = "awaiting_receipt"
+COLLECTING_INFO = "collecting_info"
+SUBMITTED = "submitted"
+TRANSITIONS = {
+    AWAITING_RECEIPT: {COLLECTING_INFO},
+    COLLECTING_INFO: {SUBMITTED},
+    SUBMITTED: set(),
+}
+
+
+def build_options() -> ClaudeAgentOptions:
+    options = ClaudeAgentOptions()
+    options.api_key = os.getenv("ANTHROPIC_API_KEY")
+    options.temperature = 0.7  # Slightly higher for more natural conversation
+    options.max_tokens = 2000  # Increased for detailed responses
+    options.top_p = 1
+    options.frequency_penalty = 0
+
+    # Set system prompt for the reimbursement manager role. It is identical for every session,
+    # so the agent's prompt caching reuses it across queries.
+    options.system_prompt = registry.get("user_interactions")
+
+    # Emit text deltas while the reply is generated, so it can be streamed to Slack
+    options.include_partial_messages = True
+    return options
+
+
 class ReimbursementManager:
     """
     An AI agent that acts as a reimbursement manager.
     Handles receipt submissions, validates information, and processes reimbursement requests.
     """
     
-    def __init__(self, user_id: str):
-        self.options = ClaudeAgentOptions()
-        self.options.api_key = os.getenv("ANTHROPIC_API_KEY")
-        self.options.temperature = 0.7  # Slightly higher for more natural conversation
-        self.options.max_tokens = 2000  # Increased for detailed responses
-        self.options.top_p = 1
-        self.options.frequency_penalty = 0
-        
-        # Set system prompt for the reimbursement manager role
-        prompt_path = Path("prompts/user_interactions.txt")
-        with prompt_path.open("r", encoding="utf-8") as f:
-            system_prompt = f.read()
-
-        self.options.system_prompt = system_prompt
-        self.agent = ClaudeSDKClient(self.options)
-
-        self.conversation_history = ""
-
-        self.valid_receipt = False
-        self.all_info_collected = False
+    def __init__(self, user_id: str, pool: Optional[AgentPool] = None):
+        """
+        Args:
+            user_id: Slack user the reimbursement is for
+            pool: Shared pool of connected agent clients. Without one, the manager connects its own
+                client for every query.
+        """
+        self.pool = pool
+        self.agent = ClaudeSDKClient(build_options()) if pool is None else None
+
+        self.memory = ConversationMemory(max_tokens=MEMORY_MAX_TOKENS)
+
+        self.state = AWAITING_RECEIPT
+        self.missing_fields = []
+        self.duplicate_submission = False
+        self.receipt = None
+        # Content keys of the receipt's files, recorded as submitted when the request is
+        self.receipt_keys = []
 
         self.user_id = user_id
 
-    def extract_recipt_data(self, downloaded_file_names: list):
+    async def extract_recipt_data(self, downloaded_files: list):
         # Acknowledge the upload
         valid = False
-        if len(downloaded_file_names) > 0:
-            for file_name in downloaded_file_names:
-                obj = extract_text(Path("downloads") / file_name)
-                if obj["is_receipt"]:
-                    if obj["too_blurry"]:
-                        return valid, "The receipt is too blurry to read! Please take a clearer image."
-                    else:
-                        valid = True
-                        return valid, f"Receipt detected! Here's the information: {obj}"
-                else:
-                    return valid, "This is not a receipt! I can only process reinbursement requests for receipts."
+        if len(downloaded_files) > 0:
+            # Every file of the upload (and every page of a PDF) is one page of the same receipt,
+            # all OCR'd at once and merged
+            try:
+                obj, cache_hit = await extract_receipt(downloaded_files)
+            except Exception as e:
+                print(f"OCR failed for {[f.name for f in downloaded_files]}: {e!r}")
+                return valid, "Sorry, I couldn't read that file in time. Please try uploading it again."
+            if not obj["is_receipt"]:
+                return valid, "This is not a receipt! I can only process reinbursement requests for receipts."
+            if obj["too_blurry"]:
+                return valid, "The receipt is too blurry to read! Please take a clearer image."
+            valid = True
+            self.receipt = obj
+            self.receipt_keys = [key for f in downloaded_files if (key := getattr(f, "key", None))]
+            # Only a receipt that went out in a request counts; images are also read again when a
+            # session expired or was abandoned before submitting
+            self.duplicate_submission = (cache_hit and len(self.receipt_keys) == len(downloaded_files)
+                                         and all(ocr_cache.was_submitted(key) for key in self.receipt_keys))
+            message = f"Receipt detected! Here's the information: {obj}"
+            if obj.get("total_matches_items") is False:
+                message += (f" Note: the receipt spans {obj['pages']} pages and its total ({obj['total']}) doesn't match"
+                            f" the sum of the line items ({obj['items_total']}). Ask the user to confirm the total.")
+            return valid, message
         else:
             return valid, "Thanks for sending the file! Unfortunately i encountered an error downloading it. 📁"
-        
-    async def process_user_message(self, message_content: str, downloaded_file_names: list):
+
+    @property
+    def valid_receipt(self) -> bool:
+        return self.state != AWAITING_RECEIPT
+
+    @property
+    def all_info_collected(self) -> bool:
+        return self.state == SUBMITTED
+
+    def _transition(self, new_state: str):
+        if new_state not in TRANSITIONS[self.state]:
+            raise ValueError(f"Invalid session transition {self.state} -> {new_state}")
+        self.state = new_state
+
+    def to_state(self) -> dict:
+        """Everything needed to rebuild this manager with from_state(), as JSON-serializable data."""
+        return {
+            "state": self.state,
+            "missing_fields": self.missing_fields,
+            "duplicate_submission": self.duplicate_submission,
+            "receipt": self.receipt,
+            "receipt_keys": self.receipt_keys,
+            "memory": self.memory.to_dict(),
+        }
+
+    @classmethod
+    def from_state(cls, user_id: str, state: dict, pool: Optional[AgentPool] = None) -> "ReimbursementManager":
+        manager = cls(user_id, pool=pool)
+        if "state" in state:
+            manager.state = state["state"]
+        else:
+            # Saved before sessions had an explicit state
+            manager.state = (SUBMITTED if state["all_info_collected"]
+                             else COLLECTING_INFO if state["valid_receipt"] else AWAITING_RECEIPT)
+        manager.missing_fields = state.get("missing_fields", [])
+        manager.duplicate_submission = state.get("duplicate_submission", False)
+        manager.receipt = state.get("receipt")
+        manager.receipt_keys = state.get("receipt_keys", [])
+        manager.memory.load_dict(state["memory"])
+        return manager
+
+    async def _ask(self, prompt: str, on_text: Optional[Callable[[str], None]] = None) -> str:
+        """
+        Send one query to the agent and return the text of its reply.
+
+        Args:
+            prompt: Query text
+            on_text: Called with the reply text received so far each time a text delta arrives
+        """
+        reply = ""
+        partial = ""
+        with telemetry.span("agent_query", state=self.state):
+            async with self._connected_agent() as agent:
+                await agent.query(prompt)
+                async for message in agent.receive_response():
+                    if isinstance(message, StreamEvent):
+                        event = message.event
+                        if on_text and event.get("type") == "content_block_delta" and event["delta"].get("type") == "text_delta":
+                            partial += event["delta"]["text"]
+                            on_text(partial)
+                    elif isinstance(message, AssistantMessage):
+                        for block in message.content:
+                            if isinstance(block, TextBlock):
+                                reply += block.text
+                    elif isinstance(message, ResultMessage):
+                        registry.record_usage("user_interactions", message.usage)
+        return reply
+
+    def _connected_agent(self):
+        if self.pool is not None:
+            return self.pool.checkout()
+        return self.agent
+
+    async def process_user_message(self, message_content: str, downloaded_files: list,
+                                   on_text: Optional[Callable[[str], None]] = None):
         """
         Process a user message, detect images, and handle the reimbursement workflow.
+        Each call makes at most one agent query.
+
+        Args:
+            on_text: Called with the user-facing reply so far while the agent is still generating it
         """
-        
-        if not self.valid_receipt:
-            if downloaded_file_names:
-                self.valid_receipt, message = self.extract_recipt_data(downloaded_file_names)
-                async with self.agent:
-                    prompt = f"Receipt is valid: {self.valid_receipt}."
-                    if self.valid_receipt:
-                        prompt += "Here is the receipt info. Remember this and remember that a valid receipt has been provided. Move onto Phase 2 next. Also infer any context and information possible from the provided receipt info:  " + message
-                    await self.agent.query(self.conversation_history + prompt)
-                    self.conversation_history += ("\n" + prompt)
-                if self.valid_receipt:
-                    async with self.agent:
-                        self.conversation_history += ("\n" +"A valid receipt has been provided. Now ask the user about any more info you need that isn't on the receipt. Do not regurgitate receipt details unless you are asked to.")
-                        await self.agent.query(self.conversation_history)
-                        async for message in self.agent.receive_response():
-                            if isinstance(message, AssistantMessage):
-                                for block in message.content:
-                                    if isinstance(block, TextBlock):
-                                        self.more_info = block.text
-                                        self.conversation_history += ("\n" + self.more_info)
-                                        return False, {"location": "dm", "content": self.more_info}
-                else:
-                    return False, {"location": "dm", "content": message}
-            else:
+
+        if self.state == AWAITING_RECEIPT:
+            if not downloaded_files:
                 return False, {"location": "dm", "content": "To start a reinbursement request, please upload a receipt image!"}
-        else:
+            valid, message = await self.extract_recipt_data(downloaded_files)
+            if not valid:
+                return False, {"location": "dm", "content": message}
+            self._transition(COLLECTING_INFO)
+            self.memory.pin("receipt", message)
+            # Only this turn's prompt carries the warning, so later turns don't repeat it
+            note = ("\nNote: this exact receipt was already submitted in an earlier request. Let the user know"
+                    " it may be a duplicate." if self.duplicate_submission else "")
+            return await self._collect_info(message_content, on_text, note)
 
-            if self.valid_receipt and downloaded_file_names:
+        if self.state == COLLECTING_INFO:
+            if downloaded_files:
                 return False, {"location": "dm", "content": "A valid receipt has already been provided! If you would like to reinburse a new receipt, please make a new request."}
-            if self.all_info_collected:
-                return True, {"location": "dm", "content": "All necessary information collected! I'll let you know if anything else is needed and when the request is completed!"}
-            else:
-                #return {"location": "dm", "content": "Still need more information. Please provide the following information: " + self.missing_info}
-                async with self.agent:
-                    all_info_message = " If all necessary information has been found, reply 'done'. DO NOT SAY ANYTHING ELSE IN RESPONSE TO THIS PART OF THE PROMPT!"
-                    await self.agent.query(self.conversation_history + message_content + all_info_message)
-                    self.conversation_history += ("\n" + message_content + all_info_message)
-                    async for message in self.agent.receive_response():
-                        if isinstance(message, AssistantMessage):
-                            for block in message.content:
-                                if isinstance(block, TextBlock):
-                                    self.more_info = block.text
-                                    self.conversation_history += ("\n" + self.more_info)
-                                    if "done" in self.more_info.lower():
-                                        self.all_info_collected = True
-                                    else:
-                                        return False, {"location": "dm", "content": self.more_info}
-                    reimbursement_request = self.build_reimbursement_request()
-                    self.conversation_history += ("\n" + reimbursement_request)
-                    await self.agent.query(self.conversation_history)
-                    async for message in self.agent.receive_response():
-                        if isinstance(message, AssistantMessage):
-                            for block in message.content:
-                                if isinstance(block, TextBlock):
-                                    self.reimbursement_request_response = block.text
-                                    self.conversation_history += ("\n" + self.reimbursement_request_response)
-                                    return True, [{"location" : "request", "content" : self.reimbursement_request_response},
-                                        {"location" : "dm", "content" : "Perfect! All necessary info has been collected! I'll get back to you once there's an update on the status of your request :)"}]
-
-    def build_reimbursement_request(self):
-        prompt = f"""
-You are generating a Slack message for an expense reimbursement request.
-
-Follow these rules STRICTLY:
-
-1. Use Slack markdown for readability.
-2. Use the section headers and order EXACTLY as specified below.
-3. Do not add any extra sections, prefixes, or explanations.
-
-The message must have these sections in this exact order:
-
-PAYMENT REQUEST
-RECEIPT DATA
-USER
-DETAILS
-
-Format each section as follows:
-
-1) PAYMENT REQUEST
-
-2) RECEIPT DATA
-- On the line immediately after 'RECEIPT DATA', output the exact receipt dictionary (provided previously in this conversation) as valid JSON.
-- Wrap the JSON in a Slack code block by placing '```' on the line before the JSON and '```' on the line after the JSON.
-- Preserve all keys, values, and types from the original dictionary. Do NOT rename keys, add new keys, or drop existing keys.
-- Use indentation (tabs or spaces) so the JSON is easy for a human to read.
-
-3) USER
-- On the line immediately after 'USER', output the Slack mention for the requesting user in this exact format:
-  <@{self.user_id}>
-- Do not add anything else on this line.
-
-4) DETAILS
-- After 'DETAILS', write 1–3 concise sentences describing:
-  - what was purchased (group similar items),
-  - why it was purchased / business purpose,
-  - any project or cost center information mentioned by the user.
-- Be brief, specific, and professional. Do not exceed 3 sentences.
-- Do NOT repeat the raw JSON; this section is a natural-language summary only.
-
-Global style guidelines (must be followed strictly):
-- Neutral, professional tone.
-- In order to bold items use single asterisks like so: *bolded text*. DO NOT USE DOUBLE ASTERISKS ANYWHERE.
-- Do NOT invent vendor names, dates, payment methods, or project names that are not supported by the receipt data or prior conversation. If something is unknown, write 'Unknown'.
-- Always format currency as '$XX.XX' with two decimal places.
-- Return ONLY the final Slack message in the required format. Do not include any additional commentary, markdown fences around the entire message, or debugging information.
-- In order to bold items use single asterisks like so: *bolded text*. DO NOT USE DOUBLE ASTERISKS ANYWHERE.
-
-Using the receipt dictionary and prior user messages, now produce the Slack reimbursement request message.
-"""
-        
-        return prompt
+            return await self._collect_info(message_content, on_text)
+
+        return True, {"location": "dm", "content": "All necessary information collected! I'll let you know if anything else is needed and when the request is completed!"}
+
+    async def _collect_info(self, message_content: str, on_text: Optional[Callable[[str], None]] = None,
+                            note: str = ""):
+        """
+        Run one Phase 2 turn: a single structured agent query that either asks for missing fields
+        or completes the request.
+
+        Args:
+            note: Extra instruction for this turn only
+        """
+        if message_content:
+            self.memory.add("user", message_content)
+        try:
+            stream = (lambda text: on_text(partial_message(text))) if on_text else None
+            reply = parse_phase2_reply(await self._ask(self.memory.render(PHASE2_INSTRUCTION + note), stream))
+        except ValueError as e:
+            print(f"Phase 2 reply rejected: {e}")
+            return False, {"location": "dm", "content": "Sorry, I got a bit confused there. Could you say that again?"}
+
+        if reply.status == "need_info":
+            self.missing_fields = reply.missing_fields
+            self.more_info = reply.message
+            self.memory.add("assistant", self.more_info)
+            return False, {"location": "dm", "content": self.more_info}
+
+        self._transition(SUBMITTED)
+        self.missing_fields = []
+        ocr_cache.mark_submitted(self.receipt_keys)
+        self.reimbursement_request_response, blocks = render_request(self.receipt, self.user_id, reply.details)
+        self.memory.pin("submitted_request", reply.details)
+        return True, [{"location" : "request", "content" : self.reimbursement_request_response, "blocks": blocks},
+            {"location" : "dm", "content" : "Perfect! All necessary info has been collected! I'll get back to you once there's an update on the status of your request :)"}]
 
     async def read_response(self, message_content: str):
-        new_message = self.conversation_history + "\n" + f"""Here is feedback from the reinbursements channel: {message_content} Was the reinbursement approved?
+        # Clear-cut replies ("approved", "denied", ✅) are settled locally without an agent query
+        response = classifier.classify(message_content)
+        if response is not None:
+            return response
+
+        instruction = f"""Here is feedback from the reinbursements channel: {message_content} Was the reinbursement approved?
         Reply in EXACTLY this format, with no extra characters before or after:""" + """{
             "relevant": <boolean>
             "approved": <boolean>
@@ -197,15 +272,16 @@ Using the receipt dictionary and prior user messages, now produce the Slack reim
         Message should be a short user facing message that can be sent to the user.
         Do not write anything other than the json object. Do not put this in a separate code block, simply put it in plain text.
         """
-        async with self.agent:
-            await self.agent.query(new_message)
-            async for message in self.agent.receive_response():
-                if isinstance(message, AssistantMessage):
-                    for block in message.content:
-                        if isinstance(block, TextBlock):
-                            print(block.text)
-                            response = json.loads(block.text.strip("`json"))
-                            return response
-        return {"relavant": False, "approved": False, "message": "No response from the reinbursements channel."}
-
-                            
+        reply = await self._ask(self.memory.render(instruction))
+        print(reply)
+        # Take the outermost {...} so code fences or stray text around the object don't break parsing
+        start, end = reply.find("{"), reply.rfind("}")
+        if start != -1 and end > start:
+            try:
+                response = json.loads(reply[start:end + 1])
+                return {"relevant": bool(response.get("relevant", response.get("relavant", False))),
+                        "approved": bool(response.get("approved", False)),
+                        "message": response.get("message", "")}
+            except json.JSONDecodeError:
+                print("Could not parse approval response")
+        return {"relevant": False, "approved": False, "message": "No response from the reinbursements channel."}
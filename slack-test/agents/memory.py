@@ -0,0 +1,84 @@
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+
+def estimate_tokens(text: str) -> int:
+    # Rough estimate that is good enough for budgeting: ~4 characters per token
+    return len(text) // 4 + 1
+
+
+@dataclass
+class Turn:
+    role: str  # "user" or "assistant"
+    text: str
+
+
+@dataclass
+class ConversationMemory:
+    """
+    Token-budgeted conversation history for one reimbursement session.
+
+    Holds pinned facts (e.g. the receipt data) that are always sent, the most recent turns verbatim,
+    and a short running summary of older turns. Whenever the turns go over max_tokens, the oldest
+    ones are folded into the summary, so the rendered prompt stays bounded however long the
+    conversation runs.
+    """
+    max_tokens: int = 3000
+    keep_recent: int = 6
+    summary_tokens: int = 600
+    snippet_chars: int = 200
+
+    facts: Dict[str, str] = field(default_factory=dict)
+    turns: List[Turn] = field(default_factory=list)
+    summary: List[str] = field(default_factory=list)
+
+    def pin(self, key: str, text: str):
+        """Store a fact that is sent with every prompt, replacing any previous value for key."""
+        self.facts[key] = text
+
+    def add(self, role: str, text: str):
+        self.turns.append(Turn(role, text))
+        self._compact()
+
+    def tokens(self) -> int:
+        return (sum(estimate_tokens(text) for text in self.facts.values())
+                + sum(estimate_tokens(line) for line in self.summary)
+                + sum(estimate_tokens(turn.text) for turn in self.turns))
+
+    def _compact(self):
+        while self.tokens() > self.max_tokens and len(self.turns) > self.keep_recent:
+            turn = self.turns.pop(0)
+            snippet = " ".join(turn.text.split())
+            if len(snippet) > self.snippet_chars:
+                snippet = snippet[:self.snippet_chars] + "…"
+            self.summary.append(f"{turn.role}: {snippet}")
+        while self.summary and sum(estimate_tokens(line) for line in self.summary) > self.summary_tokens:
+            self.summary.pop(0)
+
+    def render(self, instruction: Optional[str] = None) -> str:
+        """
+        Build the prompt for the next agent query.
+
+        Args:
+            instruction: One-shot instruction for this query only. It is sent but never stored.
+        """
+        sections = []
+        if self.facts:
+            sections.append("KNOWN FACTS:\n" + "\n".join(f"- {key}: {text}" for key, text in self.facts.items()))
+        if self.summary:
+            sections.append("EARLIER CONVERSATION (condensed):\n" + "\n".join(self.summary))
+        if self.turns:
+            sections.append("CONVERSATION:\n" + "\n".join(f"{turn.role}: {turn.text}" for turn in self.turns))
+        if instruction:
+            sections.append("INSTRUCTION:\n" + instruction)
+        return "\n\n".join(sections)
+
+    def to_dict(self) -> dict:
+        return {"facts": dict(self.facts), "summary": list(self.summary),
+                "turns": [asdict(turn) for turn in self.turns]}
+
+    def load_dict(self, data: dict):
+        """Restore facts, summary and turns saved by to_dict()."""
+        self.facts = dict(data.get("facts", {}))
+        self.summary = list(data.get("summary", []))
+        self.turns = [Turn(**turn) for turn in data.get("turns", [])]
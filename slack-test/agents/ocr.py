@@ -1,50 +1,236 @@
-from PIL import Image
+from PIL import Image, ImageOps
 import anthropic
 from dotenv import load_dotenv
+import asyncio
 import json
+import mmap
+import os
 import base64
+import time
 from io import BytesIO
+from pathlib import Path
+from agents import telemetry
+from agents.ocr_cache import OCRCache
+from agents.prompts import registry
+from agents.prescreen import prescreen
 
 load_dotenv()
 
-client = anthropic.Anthropic()
-
-f = open("prompts/ocr.txt", "r")
-prompt = f.read()
-f.close()
-
-def extract_text(file_path):
-    image = Image.open(file_path)
-    
-    # Convert image to base64 properly
-    buffer = BytesIO()
-    # Ensure we have a format, default to PNG if unknown
-    format = image.format if image.format else 'PNG'
-    image.save(buffer, format=format)
-    image_base64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
-    resp = client.messages.create(
-        model="claude-haiku-4-5",
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": "image/{extension}".format(extension=format.lower()),
-                            "data": image_base64
-                        }
-                    },
-                    {
-                        "type": "text",
-                        "text": prompt
+async_client = anthropic.AsyncAnthropic()
+
+OCR_MODEL = "claude-haiku-4-5"
+
+# Max number of vision calls in flight at once, and how long a single call may take (seconds)
+OCR_CONCURRENCY = int(os.getenv("OCR_CONCURRENCY", "4"))
+OCR_TIMEOUT = float(os.getenv("OCR_TIMEOUT", "60"))
+
+# Preprocessing: longest image edge in pixels, byte budget for the encoded image, and grayscale normalization
+OCR_MAX_EDGE = int(os.getenv("OCR_MAX_EDGE", "1568"))
+OCR_TARGET_BYTES = int(os.getenv("OCR_TARGET_BYTES", "400000"))
+OCR_GRAYSCALE = os.getenv("OCR_GRAYSCALE", "1") == "1"
+
+# Formats the vision API accepts as-is
+MEDIA_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "GIF": "image/gif", "WEBP": "image/webp"}
+
+_semaphore = None
+
+# OCR results keyed by image hash. OCR_CACHE_PATH="" keeps the cache in memory only.
+cache = OCRCache(
+    path=os.getenv("OCR_CACHE_PATH", "ocr_cache.sqlite3"),
+    max_entries=int(os.getenv("OCR_CACHE_MAX_ENTRIES", "256")),
+    max_bytes=int(os.getenv("OCR_CACHE_MAX_BYTES", str(4 * 1024 * 1024))),
+    ttl=float(os.getenv("OCR_CACHE_TTL", str(7 * 24 * 3600))),
+)
+
+# The OCR instructions go in a cached system prompt; the user turn only carries the image
+OCR_REQUEST = "Extract the receipt information from this image as instructed."
+
+
+def _get_semaphore():
+    # Created lazily so it binds to the running event loop
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(OCR_CONCURRENCY)
+    return _semaphore
+
+
+def _needs_processing(image, size):
+    if size > OCR_TARGET_BYTES or image.format not in MEDIA_TYPES:
+        return True
+    if max(image.size) > OCR_MAX_EDGE:
+        return True
+    # EXIF orientation other than "normal" means the pixels need rotating
+    return image.getexif().get(0x0112, 1) != 1
+
+
+def _encode_within_budget(image):
+    # Step JPEG quality down first, then shrink the image if quality alone isn't enough
+    while True:
+        for quality in (85, 75, 65, 55, 45):
+            buffer = BytesIO()
+            image.save(buffer, format="JPEG", quality=quality, optimize=True)
+            if buffer.tell() <= OCR_TARGET_BYTES:
+                return buffer.getvalue()
+        if max(image.size) <= 512:
+            return buffer.getvalue()
+        image = image.resize((int(image.width * 0.75), int(image.height * 0.75)), Image.LANCZOS)
+
+
+def _load_bytes(source):
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source)
+    if isinstance(source, mmap.mmap):
+        return source
+    # Paths and downloads both expose read_bytes(); downloads on disk come back memory-mapped
+    if hasattr(source, "read_bytes"):
+        return source.read_bytes()
+    return Path(source).read_bytes()
+
+
+def preprocess_image(source):
+    """
+    Prepare an image for the vision call. source is a file path or the raw image bytes.
+
+    Rotates according to EXIF, normalizes to grayscale with stretched contrast, downscales to
+    OCR_MAX_EDGE and re-encodes as JPEG within OCR_TARGET_BYTES. Files that are already small,
+    upright and in a supported format are passed through untouched.
+
+    Returns:
+        (data, media_type, stats) where stats holds original_bytes, output_bytes, bytes_saved,
+        seconds and skipped
+    """
+    with telemetry.span("preprocess"):
+        return _preprocess(source)
+
+
+def _preprocess(source):
+    start = time.perf_counter()
+    raw = _load_bytes(source)
+    with Image.open(BytesIO(raw)) as image:
+        if not _needs_processing(image, len(raw)):
+            data, media_type, skipped = raw, MEDIA_TYPES[image.format], True
+        else:
+            processed = ImageOps.exif_transpose(image)
+            if OCR_GRAYSCALE:
+                processed = ImageOps.autocontrast(ImageOps.grayscale(processed), cutoff=1)
+            elif processed.mode != "RGB":
+                processed = processed.convert("RGB")
+            processed.thumbnail((OCR_MAX_EDGE, OCR_MAX_EDGE), Image.LANCZOS)
+            data, media_type, skipped = _encode_within_budget(processed), "image/jpeg", False
+
+    stats = {
+        "original_bytes": len(raw),
+        "output_bytes": len(data),
+        "bytes_saved": len(raw) - len(data),
+        "seconds": time.perf_counter() - start,
+        "skipped": skipped,
+    }
+    print(f"Preprocessed image: {stats['original_bytes']} -> {stats['output_bytes']} bytes "
+          f"in {stats['seconds'] * 1000:.1f}ms" + (" (skipped)" if skipped else ""))
+    return data, media_type, stats
+
+
+def _build_messages(source):
+    data, media_type, _ = preprocess_image(source)
+    image_base64 = base64.b64encode(data).decode("utf-8")
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "image",
+                    "source": {
+                        "type": "base64",
+                        "media_type": media_type,
+                        "data": image_base64
                     }
-                ]
-            }
-        ],
-        max_tokens=4096
-    )
-    image.close()
+                },
+                {
+                    "type": "text",
+                    "text": OCR_REQUEST
+                }
+            ]
+        }
+    ]
+
+
+def build_request(source) -> dict:
+    """Messages API parameters for reading one image, as sent by extract_text_cached."""
+    return {
+        "model": OCR_MODEL,
+        "system": registry.cached_system("ocr"),
+        "messages": _build_messages(source),
+        "max_tokens": 4096,
+    }
+
+
+async def extract_text_cached(file_path, timeout=None, client=None):
+    """
+    Read one receipt image with the vision model, backed by the OCR result cache.
+
+    At most OCR_CONCURRENCY calls run at once; callers beyond that wait for a free slot.
+    Image preprocessing runs in a worker thread so the event loop is never blocked.
+
+    Args:
+        file_path: Path to the image to read, or any object with read_bytes() such as an IngestedFile.
+            An IngestedFile's key is used as the cache key, and its stored file is memory-mapped.
+        timeout: Seconds allowed for the vision call, defaults to OCR_TIMEOUT
+        client: AsyncAnthropic client to call, defaults to the module client
+
+    Returns:
+        (result, cache_hit) where cache_hit is True if these exact image bytes were read before
+
+    Raises:
+        asyncio.TimeoutError: If the call takes longer than timeout
+    """
+    timeout = OCR_TIMEOUT if timeout is None else timeout
+    # Stored downloads already carry their content hash, so a cache hit doesn't read the file at all
+    key = getattr(file_path, "key", None)
+    raw = None
+    if key is None:
+        raw = await asyncio.to_thread(_load_bytes, file_path)
+        key = cache.key_for(raw)
+    cached = cache.get(key)
+    telemetry.ocr_cache.inc(result="hit" if cached is not None else "miss")
+    if cached is not None:
+        return cached, True
+    if raw is None:
+        raw = await asyncio.to_thread(_load_bytes, file_path)
+
+    # Clearly unusable images are answered locally, without a vision call
+    with telemetry.span("prescreen"):
+        rejected = await asyncio.to_thread(prescreen, raw)
+    if rejected is not None:
+        return rejected, False
+
+    async with _get_semaphore():
+        messages = await asyncio.to_thread(_build_messages, raw)
+        with telemetry.span("extract_text", model=OCR_MODEL):
+            resp = await asyncio.wait_for(
+                (client or async_client).messages.create(
+                    model=OCR_MODEL,
+                    system=registry.cached_system("ocr"),
+                    messages=messages,
+                    max_tokens=4096
+                ),
+                timeout=timeout,
+            )
+    registry.record_usage("ocr", resp.usage)
     print(resp.content[0].text)
-    return json.loads(resp.content[0].text)
\ No newline at end of file
+    result = json.loads(resp.content[0].text)
+    cache.put(key, result)
+    return result, False
+
+
+async def extract_text_many(file_paths, timeout=None, client=None):
+    """
+    Run extract_text_cached over several files in parallel.
+
+    Returns:
+        List with one (result, cache_hit) entry per file, in the same order. Failed files hold the
+        exception instead.
+    """
+    return await asyncio.gather(
+        *(extract_text_cached(file_path, timeout=timeout, client=client) for file_path in file_paths),
+        return_exceptions=True,
+    )
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class OCRCache:
+    """
+    Content-addressed cache for OCR results.
+    Keys are the SHA-256 of the raw image bytes. Entries live in a small in-memory LRU
+    in front of a SQLite table, and both tiers expire entries after ttl seconds.
+
+    Also records which images were part of a submitted reimbursement request, so a re-upload of
+    one can be told apart from an image that was only read before. These records expire after ttl too.
+    """
+
+    def __init__(self, path: Optional[str] = "ocr_cache.sqlite3", max_entries: int = 256,
+                 max_bytes: int = 4 * 1024 * 1024, ttl: float = 7 * 24 * 3600):
+        """
+        Args:
+            path: SQLite file for the on-disk tier. None or "" keeps the cache in memory only.
+            max_entries: Max number of results held in the memory tier
+            max_bytes: Max total size of serialized results held in the memory tier
+            ttl: Seconds before an entry expires, in either tier
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        # Format: {key: (stored_at, size, result)}
+        self.memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self.memory_bytes = 0
+        # Used instead of the submitted table when there is no SQLite file. Format: {key: submitted_at}
+        self.submitted: dict = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS ocr_results ("
+                "key TEXT PRIMARY KEY, stored_at REAL NOT NULL, result TEXT NOT NULL)"
+            )
+            self.db.execute("CREATE TABLE IF NOT EXISTS submitted (key TEXT PRIMARY KEY, submitted_at REAL NOT NULL)")
+            self.db.commit()
+
+    @staticmethod
+    def key_for(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def _remember(self, key: str, stored_at: float, result: dict, size: int):
+        if key in self.memory:
+            self.memory_bytes -= self.memory.pop(key)[1]
+        self.memory[key] = (stored_at, size, result)
+        self.memory_bytes += size
+        while self.memory and (len(self.memory) > self.max_entries or self.memory_bytes > self.max_bytes):
+            _, (_, evicted_size, _) = self.memory.popitem(last=False)
+            self.memory_bytes -= evicted_size
+
+    def get(self, key: str) -> Optional[dict]:
+        """Return the cached result for key, or None on a miss or an expired entry."""
+        now = time.time()
+        entry = self.memory.get(key)
+        if entry is not None:
+            stored_at, _, result = entry
+            if now - stored_at <= self.ttl:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return result
+            self.invalidate(key)
+
+        if self.db is not None:
+            row = self.db.execute("SELECT stored_at, result FROM ocr_results WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                stored_at, serialized = row
+                if now - stored_at <= self.ttl:
+                    result = json.loads(serialized)
+                    self._remember(key, stored_at, result, len(serialized))
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return result
+                self.invalidate(key)
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, result: dict):
+        stored_at = time.time()
+        serialized = json.dumps(result)
+        self._remember(key, stored_at, result, len(serialized))
+        if self.db is not None:
+            self.db.execute(
+                "INSERT OR REPLACE INTO ocr_results (key, stored_at, result) VALUES (?, ?, ?)",
+                (key, stored_at, serialized),
+            )
+            self.db.commit()
+
+    def mark_submitted(self, keys):
+        """Record that the images with these keys were submitted for reimbursement."""
+        now = time.time()
+        if self.db is None:
+            self.submitted.update((key, now) for key in keys)
+            return
+        self.db.executemany("INSERT OR REPLACE INTO submitted (key, submitted_at) VALUES (?, ?)",
+                            [(key, now) for key in keys])
+        self.db.commit()
+
+    def was_submitted(self, key: str) -> bool:
+        """Whether the image with this key was submitted for reimbursement within the last ttl seconds."""
+        if self.db is None:
+            submitted_at = self.submitted.get(key)
+        else:
+            row = self.db.execute("SELECT submitted_at FROM submitted WHERE key = ?", (key,)).fetchone()
+            submitted_at = row[0] if row else None
+        return submitted_at is not None and time.time() - submitted_at <= self.ttl
+
+    def invalidate(self, key: Optional[str] = None):
+        """Drop one entry from both tiers, or everything when key is None."""
+        if key is None:
+            self.memory.clear()
+            self.memory_bytes = 0
+            if self.db is not None:
+                self.db.execute("DELETE FROM ocr_results")
+                self.db.commit()
+            return
+
+        entry = self.memory.pop(key, None)
+        if entry is not None:
+            self.memory_bytes -= entry[1]
+        if self.db is not None:
+            self.db.execute("DELETE FROM ocr_results WHERE key = ?", (key,))
+            self.db.commit()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory_bytes,
+        }
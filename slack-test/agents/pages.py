@@ -0,0 +1,138 @@
+"""
+Receipts that span several pages: multi-page PDFs, or one receipt photographed in several pieces.
+
+Every page is OCR'd on its own, all at once, and the page results are merged into a single receipt
+object in page order. OCR_CONCURRENCY should be at least the usual page count, or pages queue up.
+"""
+import asyncio
+import os
+from io import BytesIO
+from typing import List, Optional, Tuple
+
+from agents.ocr import OCR_GRAYSCALE, OCR_MAX_EDGE, _load_bytes, extract_text_many
+
+# Pages past this are ignored, so a huge PDF can't run up a huge bill
+OCR_MAX_PAGES = int(os.getenv("OCR_MAX_PAGES", "10"))
+# Max pixels per point PDF pages are rendered at (2 = 144 DPI). Pages are also kept within
+# OCR_MAX_EDGE, so preprocessing usually has nothing left to do.
+PDF_RENDER_SCALE = float(os.getenv("PDF_RENDER_SCALE", "2"))
+
+# Totals within this many dollars of the line items are taken to match (rounding, per-item tax)
+TOTAL_TOLERANCE = 0.01
+
+NOT_FOUND = "Not Found"
+
+
+def is_pdf(data: bytes) -> bool:
+    return data[:5] == b"%PDF-"
+
+
+def split_pages(source) -> List[bytes]:
+    """
+    Split an upload into page images: one JPEG per PDF page, or the image (or stored download) itself.
+
+    Args:
+        source: Raw bytes, a path, or any object with read_bytes() such as an IngestedFile
+    """
+    data = _load_bytes(source)
+    if not is_pdf(data):
+        # A stored download keeps its content hash, so the OCR cache can be checked without hashing it again
+        return [source] if getattr(source, "key", None) else [data]
+
+    # Only needed for PDFs, so image-only deployments don't have to install it
+    import pypdfium2 as pdfium
+
+    # pdfium takes bytes or a path, not a memory-mapped file
+    pdf = pdfium.PdfDocument(data if isinstance(data, bytes) else bytes(data))
+    try:
+        pages = []
+        for index in range(min(len(pdf), OCR_MAX_PAGES)):
+            page = pdf[index]
+            scale = min(PDF_RENDER_SCALE, OCR_MAX_EDGE / max(page.get_size()))
+            image = page.render(scale=scale, grayscale=OCR_GRAYSCALE).to_pil()
+            buffer = BytesIO()
+            image.save(buffer, format="JPEG", quality=85)
+            pages.append(buffer.getvalue())
+        return pages
+    finally:
+        pdf.close()
+
+
+def _known(value) -> bool:
+    return value not in (None, "", NOT_FOUND)
+
+
+def _amount(value) -> Optional[float]:
+    try:
+        return round(float(value), 2)
+    except (TypeError, ValueError):
+        return None
+
+
+def merge_receipts(pages: List[dict]) -> dict:
+    """
+    Merge per-page OCR results into one receipt, deterministically.
+
+    Pages that aren't a receipt (a cover sheet, a stray photo) are dropped. If any receipt page is too
+    blurry, the whole receipt is, since its total can't be checked. Line items are concatenated in page
+    order, and store name, date and location come from the first page that has them.
+
+    The total is the page total that equals the sum of the line items; failing that, the sum of the
+    page totals if each page printed its own subtotal; failing that, the last page's total, with
+    total_matches_items set to False.
+
+    Returns:
+        A result in the prompts/ocr.txt format, plus pages, items_total and total_matches_items
+    """
+    receipts = [page for page in pages if page.get("is_receipt")]
+    if not receipts:
+        return {"is_receipt": False}
+    if any(page.get("too_blurry") for page in receipts):
+        return {"is_receipt": True, "too_blurry": True}
+    if len(pages) == 1:
+        return receipts[0]
+
+    items = [item for page in receipts for item in page.get("items") or []]
+    items_total = round(sum(_amount(item.get("price")) or 0.0 for item in items), 2)
+    page_totals = [total for page in receipts if (total := _amount(page.get("total"))) is not None]
+
+    def matches(total):
+        return abs(total - items_total) <= TOTAL_TOLERANCE
+
+    total = next((total for total in reversed(page_totals) if matches(total)), None)
+    if total is None and len(page_totals) > 1 and matches(round(sum(page_totals), 2)):
+        total = round(sum(page_totals), 2)
+    total_matches_items = total is not None
+    if total is None:
+        total = page_totals[-1] if page_totals else items_total
+
+    merged = {"is_receipt": True, "too_blurry": False, "items": items}
+    for field in ("date", "location", "store_name"):
+        merged[field] = next((page[field] for page in receipts if _known(page.get(field))), NOT_FOUND)
+    merged.update(total=total, pages=len(receipts), items_total=items_total, total_matches_items=total_matches_items)
+    return merged
+
+
+async def extract_receipt(files, timeout=None, client=None) -> Tuple[dict, bool]:
+    """
+    OCR one receipt made of one or more uploads, every page in parallel.
+
+    Args:
+        files: Images or PDFs, in page order
+        timeout: Seconds allowed per vision call, defaults to OCR_TIMEOUT
+        client: AsyncAnthropic client to call, defaults to the OCR module's client
+
+    Returns:
+        (result, cache_hit): the merged receipt, and whether every page had been read before
+
+    Raises:
+        The first exception any page's OCR raised
+    """
+    split = await asyncio.gather(*(asyncio.to_thread(split_pages, source) for source in files))
+    pages = [page for file_pages in split for page in file_pages][:OCR_MAX_PAGES]
+    results = await extract_text_many(pages, timeout=timeout, client=client)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    merged = merge_receipts([result for result, _ in results])
+    return merged, all(cache_hit for _, cache_hit in results)
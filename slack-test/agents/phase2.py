@@ -0,0 +1,116 @@
+import json
+import re
+from typing import List, Literal
+
+from pydantic import BaseModel, ValidationError, field_validator, model_validator
+
+# Sent with every Phase 2 query; the reply must be a single Phase2Reply JSON object
+PHASE2_INSTRUCTION = """You are in PHASE 2. Decide whether all necessary information for the reimbursement request has been collected, using the receipt data and the conversation above.
+Reply with ONE JSON object and nothing else, no code block, in exactly one of these two shapes:
+
+If information is still missing:
+{"status": "need_info", "missing_fields": ["<field>", ...], "message": "<brief, friendly message to the user asking for the missing information, with example answers>"}
+
+If everything needed has been collected:
+{"status": "complete", "missing_fields": [], "details": "<1-3 concise sentences for the DETAILS section: what was purchased (group similar items), the business purpose, and any project or cost center information mentioned by the user>"}
+
+Rules for "details": neutral, professional tone; do not repeat the raw receipt data; do not invent vendor names, dates, payment methods or project names (write 'Unknown' instead); format currency as '$XX.XX'.
+In "message", do not regurgitate receipt details unless the user asked for them. To bold text use single asterisks like so: *bolded text*."""
+
+# Sentence boundary used to keep DETAILS to at most three sentences
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+class Phase2Reply(BaseModel):
+    status: Literal["need_info", "complete"]
+    missing_fields: List[str] = []
+    message: str = ""
+    details: str = ""
+
+    @field_validator("details")
+    @classmethod
+    def _at_most_three_sentences(cls, details: str) -> str:
+        return " ".join(_SENTENCE_END.split(details.strip())[:3])
+
+    @model_validator(mode="after")
+    def _has_payload(self) -> "Phase2Reply":
+        if self.status == "need_info" and not self.message.strip():
+            raise ValueError("need_info reply without a message")
+        if self.status == "complete" and not self.details:
+            raise ValueError("complete reply without details")
+        return self
+
+
+# Opening code fence with an optional language tag, e.g. "```json\n"
+_FENCE = re.compile(r"`{3,}[\w+-]*[ \t]*\r?\n\s*")
+
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+def partial_message(text: str) -> str:
+    """
+    The part of the user-facing message available so far in a Phase 2 reply that is still streaming.
+
+    Returns the decoded prefix of the "message" string for a JSON reply (empty until it starts, and
+    always empty for a "complete" reply), or the text itself if the reply is plain prose. A JSON reply
+    wrapped in a code fence is read the same as a bare one.
+    """
+    stripped = text.lstrip()
+    if stripped.startswith("```") or stripped and "```".startswith(stripped):
+        fence = _FENCE.match(stripped)
+        if not fence:
+            # Still streaming the opening fence or its language tag
+            return ""
+        stripped = stripped[fence.end():]
+    if not stripped:
+        return ""
+    if not stripped.startswith("{"):
+        return stripped
+    match = re.search(r'"message"\s*:\s*"', text)
+    if not match:
+        return ""
+
+    out = []
+    i = match.end()
+    while i < len(text):
+        char = text[i]
+        if char == '"':
+            break
+        if char == "\\":
+            if i + 1 >= len(text):
+                break
+            code = text[i + 1]
+            if code == "u":
+                if i + 6 > len(text):
+                    break
+                try:
+                    out.append(chr(int(text[i + 2:i + 6], 16)))
+                except ValueError:
+                    pass
+                i += 6
+                continue
+            out.append(_ESCAPES.get(code, code))
+            i += 2
+            continue
+        out.append(char)
+        i += 1
+    return "".join(out)
+
+
+def parse_phase2_reply(text: str) -> Phase2Reply:
+    """
+    Parse and validate the agent's Phase 2 reply.
+
+    A reply that isn't JSON at all is taken as a plain question for the user, so a model that ignores
+    the format still moves the conversation forward instead of failing the turn.
+
+    Raises:
+        ValueError: If the reply is JSON that doesn't match the schema
+    """
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end < start:
+        return Phase2Reply(status="need_info", message=text.strip() or "Could you tell me a bit more about this purchase?")
+    try:
+        return Phase2Reply.model_validate(json.loads(text[start:end + 1]))
+    except (json.JSONDecodeError, ValidationError) as e:
+        raise ValueError(f"Invalid Phase 2 reply: {e}") from e
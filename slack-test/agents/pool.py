@@ -0,0 +1,163 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Callable
+
+from claude_agent_sdk import ClaudeAgentOptions, ClaudeSDKClient
+
+
+class AgentPool:
+    """
+    Pool of long-lived, connected ClaudeSDKClients shared by all sessions.
+
+    Sessions check a client out for one query and hand it back afterwards, instead of paying for a
+    connect/disconnect on every turn. Returned clients have their transcript cleared so no context
+    leaks between users. Clients that fail a health check are replaced, and clients idle for longer
+    than max_idle are disconnected down to min_idle warm clients.
+    """
+
+    def __init__(self, options_factory: Callable[[], ClaudeAgentOptions], size: int = 4, min_idle: int = 1,
+                 max_idle: float = 300.0, reap_interval: float = 30.0, reset_timeout: float = 10.0,
+                 client_factory: Callable[[ClaudeAgentOptions], ClaudeSDKClient] = ClaudeSDKClient):
+        """
+        Args:
+            options_factory: Returns the options for each new client
+            size: Max number of clients, i.e. max concurrent queries
+            min_idle: Number of clients kept connected even when idle
+            max_idle: Seconds an idle client above min_idle is kept before being disconnected
+            reap_interval: Seconds between idle reaping passes
+            reset_timeout: Seconds allowed for clearing a returned client's transcript
+            client_factory: Builds a client from options, swappable for tests and benchmarks
+        """
+        self.options_factory = options_factory
+        self.client_factory = client_factory
+        self.size = size
+        self.min_idle = min(min_idle, size)
+        self.max_idle = max_idle
+        self.reap_interval = reap_interval
+        self.reset_timeout = reset_timeout
+
+        # Format: deque of (client, returned_at); the most recently used client is on the right
+        self._idle = deque()
+        self._slots = asyncio.Semaphore(size)
+        self._reaper = None
+
+        self.checkouts = 0
+        self.in_use = 0
+        self.created = 0
+        self.discarded = 0
+        self.reaped = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def _new_client(self) -> ClaudeSDKClient:
+        client = self.client_factory(self.options_factory())
+        await client.connect()
+        self.created += 1
+        return client
+
+    async def _discard(self, client: ClaudeSDKClient):
+        self.discarded += 1
+        try:
+            await client.disconnect()
+        except Exception as e:
+            print(f"Failed to disconnect agent client: {e!r}")
+
+    @staticmethod
+    def _is_healthy(client: ClaudeSDKClient) -> bool:
+        transport = getattr(client, "_transport", None)
+        return transport is not None and transport.is_ready()
+
+    async def _reset(self, client: ClaudeSDKClient):
+        # /clear wipes the transcript but keeps the connection
+        await client.query("/clear")
+        async for _ in client.receive_response():
+            pass
+
+    async def start(self):
+        """Pre-warm min_idle clients and start the idle reaper."""
+        if self._reaper is not None:
+            return
+        # Set before awaiting so concurrent first checkouts don't each pre-warm
+        self._reaper = asyncio.create_task(self._reap_forever())
+        while len(self._idle) < self.min_idle:
+            self._idle.append((await self._new_client(), time.monotonic()))
+
+    async def close(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        while self._idle:
+            client, _ = self._idle.pop()
+            await self._discard(client)
+
+    async def _reap_forever(self):
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            await self.reap()
+
+    async def reap(self):
+        """Disconnect clients that sat idle for longer than max_idle, keeping min_idle warm."""
+        now = time.monotonic()
+        while len(self._idle) > self.min_idle and now - self._idle[0][1] > self.max_idle:
+            client, _ = self._idle.popleft()
+            self.reaped += 1
+            await self._discard(client)
+
+    @asynccontextmanager
+    async def checkout(self):
+        """Borrow a connected client for the duration of the block."""
+        if self._reaper is None:
+            await self.start()
+
+        waited_from = time.perf_counter()
+        await self._slots.acquire()
+        waited = time.perf_counter() - waited_from
+        self.checkouts += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+        client = None
+        try:
+            while self._idle and client is None:
+                candidate, _ = self._idle.pop()
+                if self._is_healthy(candidate):
+                    client = candidate
+                else:
+                    await self._discard(candidate)
+            if client is None:
+                client = await self._new_client()
+
+            self.in_use += 1
+            try:
+                yield client
+            except BaseException:
+                # The client may be mid-response; don't hand it to anyone else
+                await self._discard(client)
+                client = None
+                raise
+            finally:
+                self.in_use -= 1
+
+            try:
+                await asyncio.wait_for(self._reset(client), timeout=self.reset_timeout)
+                self._idle.append((client, time.monotonic()))
+            except Exception as e:
+                print(f"Failed to reset agent client, discarding it: {e!r}")
+                await self._discard(client)
+        finally:
+            self._slots.release()
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "idle": len(self._idle),
+            "in_use": self.in_use,
+            "checkouts": self.checkouts,
+            "created": self.created,
+            "discarded": self.discarded,
+            "reaped": self.reaped,
+            "wait_avg": self.wait_total / self.checkouts if self.checkouts else 0.0,
+            "wait_max": self.wait_max,
+        }
@@ -0,0 +1,180 @@
+"""
+Local pre-screening of uploaded images, run before the OCR vision call.
+
+Rejects images that are clearly unreadable or clearly not a receipt using cheap NumPy/PIL heuristics,
+returning the same result shape the OCR model would. Anything borderline is let through.
+
+Run against a labeled sample set to measure the rejection and false-reject rates:
+
+    python -m agents.prescreen samples.csv
+
+where samples.csv has "path,label" rows and label is one of receipt, blurry or not_receipt.
+"""
+import csv
+import mmap
+import os
+import sys
+from dataclasses import dataclass
+from io import BytesIO
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+# Images are analysed at this size so the thresholds don't depend on the camera resolution
+ANALYSIS_EDGE = 1000
+
+
+@dataclass
+class PrescreenConfig:
+    enabled: bool = os.getenv("PRESCREEN_ENABLED", "1") == "1"
+    # Variance of the Laplacian below which the image is too blurry to read
+    min_sharpness: float = float(os.getenv("PRESCREEN_MIN_SHARPNESS", "40"))
+    # Shortest side in pixels below which no receipt text could be legible
+    min_edge: int = int(os.getenv("PRESCREEN_MIN_EDGE", "200"))
+    # Long side / short side above which the image is a banner or strip, not a receipt
+    max_aspect: float = float(os.getenv("PRESCREEN_MAX_ASPECT", "8"))
+    # Pixel standard deviation below which the image is a flat, blank picture
+    min_contrast: float = float(os.getenv("PRESCREEN_MIN_CONTRAST", "8"))
+    # Coarse-scale gradient below which a low-contrast image has no structure at all. Blur lowers
+    # contrast too, but a blurred receipt keeps the edge energy of its text lines.
+    min_edge_energy: float = float(os.getenv("PRESCREEN_MIN_EDGE_ENERGY", "0.5"))
+    # Fraction of pixels on strong edges below which a sharp image has no text on it
+    min_text_density: float = float(os.getenv("PRESCREEN_MIN_TEXT_DENSITY", "0.005"))
+
+
+config = PrescreenConfig()
+
+screened = 0
+rejections = {"too_small": 0, "aspect": 0, "blank": 0, "blurry": 0, "no_text": 0}
+
+
+def measure(image: Image.Image) -> dict:
+    """Compute the metrics the pre-screen decides on."""
+    width, height = image.size
+    gray = ImageOps.exif_transpose(image).convert("L")
+    gray.thumbnail((ANALYSIS_EDGE, ANALYSIS_EDGE))
+    pixels = np.asarray(gray, dtype=np.float32)
+
+    # 4-neighbour Laplacian; its variance is a standard focus measure
+    laplacian = (4 * pixels[1:-1, 1:-1] - pixels[:-2, 1:-1] - pixels[2:, 1:-1]
+                 - pixels[1:-1, :-2] - pixels[1:-1, 2:])
+    # Strong horizontal/vertical gradients approximate printed character strokes
+    gradient = np.abs(np.diff(pixels, axis=1))[:-1, :] + np.abs(np.diff(pixels, axis=0))[:, :-1]
+    # Mean gradient of an 8x smaller copy: survives blur, while sensor noise and smooth lighting average out
+    coarse = np.asarray(gray.reduce(8), dtype=np.float32)
+    edge_energy = (float(np.abs(np.diff(coarse, axis=1)).mean() + np.abs(np.diff(coarse, axis=0)).mean())
+                   if min(coarse.shape) > 1 else 0.0)
+
+    return {
+        "width": width,
+        "height": height,
+        "aspect": max(width, height) / max(1, min(width, height)),
+        "contrast": float(pixels.std()),
+        "sharpness": float(laplacian.var()) if laplacian.size else 0.0,
+        "text_density": float((gradient > 60).mean()) if gradient.size else 0.0,
+        "edge_energy": edge_energy,
+    }
+
+
+def screen(source, cfg: Optional[PrescreenConfig] = None) -> Tuple[Optional[dict], Optional[str], dict]:
+    """
+    Decide whether an image is clearly bad without calling the API.
+
+    Args:
+        source: Raw image bytes (or a memory-mapped file) or a path
+        cfg: Thresholds, defaults to the module config
+
+    Returns:
+        (result, reason, metrics). result is None when the image should go to OCR, otherwise an
+        OCR-result-shaped dict such as {"is_receipt": False} or {"is_receipt": True, "too_blurry": True}.
+    """
+    cfg = cfg or config
+    # Memory-mapped stored files are bytes-like too
+    data = source if isinstance(source, (bytes, bytearray, mmap.mmap)) else Path(source).read_bytes()
+    with Image.open(BytesIO(data)) as image:
+        metrics = measure(image)
+
+    if min(metrics["width"], metrics["height"]) < cfg.min_edge:
+        return {"is_receipt": True, "too_blurry": True}, "too_small", metrics
+    if metrics["aspect"] > cfg.max_aspect:
+        return {"is_receipt": False}, "aspect", metrics
+    if metrics["contrast"] < cfg.min_contrast and metrics["edge_energy"] < cfg.min_edge_energy:
+        return {"is_receipt": False}, "blank", metrics
+    # Blur also wipes out edges, so check it before concluding there is no text
+    if metrics["sharpness"] < cfg.min_sharpness:
+        return {"is_receipt": True, "too_blurry": True}, "blurry", metrics
+    if metrics["text_density"] < cfg.min_text_density:
+        return {"is_receipt": False}, "no_text", metrics
+    return None, None, metrics
+
+
+def prescreen(source) -> Optional[dict]:
+    """Run screen() with the module config and count the outcome. Returns the rejection result, or None."""
+    global screened
+    if not config.enabled:
+        return None
+    result, reason, metrics = screen(source)
+    screened += 1
+    if reason:
+        rejections[reason] += 1
+        print(f"Pre-screen rejected image ({reason}): {metrics}")
+    return result
+
+
+def stats() -> dict:
+    rejected = sum(rejections.values())
+    return {
+        "screened": screened,
+        "rejected": rejected,
+        "rejection_rate": rejected / screened if screened else 0.0,
+        "rejections": dict(rejections),
+    }
+
+
+def evaluate(samples_csv: str, cfg: Optional[PrescreenConfig] = None) -> dict:
+    """
+    Score the pre-screen against labeled samples.
+
+    Args:
+        samples_csv: CSV of path,label rows; label is receipt, blurry or not_receipt. Relative paths
+            are resolved against the CSV's folder.
+
+    Returns:
+        dict with the overall rejection rate, and the false-reject rate: the share of readable
+        receipts that the pre-screen would have rejected
+    """
+    base = os.path.dirname(os.path.abspath(samples_csv))
+    total = rejected = receipts = false_rejects = 0
+    by_label = {}
+    with open(samples_csv, newline="") as f:
+        for row in csv.DictReader(f):
+            path = os.path.join(base, row["path"])
+            label = row["label"].strip()
+            _, reason, _ = screen(path, cfg)
+            total += 1
+            rejected += reason is not None
+            counts = by_label.setdefault(label, {"total": 0, "rejected": 0})
+            counts["total"] += 1
+            counts["rejected"] += reason is not None
+            if label == "receipt":
+                receipts += 1
+                false_rejects += reason is not None
+    return {
+        "samples": total,
+        "rejection_rate": rejected / total if total else 0.0,
+        "false_reject_rate": false_rejects / receipts if receipts else 0.0,
+        "by_label": by_label,
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit("usage: python -m agents.prescreen samples.csv")
+    report = evaluate(sys.argv[1])
+    print(f"samples: {report['samples']}")
+    print(f"rejection rate: {report['rejection_rate']:.1%}")
+    print(f"false-reject rate: {report['false_reject_rate']:.1%}")
+    for label, counts in sorted(report["by_label"].items()):
+        print(f"  {label}: {counts['rejected']}/{counts['total']} rejected")
@@ -0,0 +1,74 @@
+from pathlib import Path
+from typing import Dict, Optional
+
+from agents import telemetry
+
+# Resolved from this file so prompts load no matter what the working directory is
+PROMPTS_DIR = Path(__file__).resolve().parent.parent / "prompts"
+
+USAGE_FIELDS = ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
+
+
+class PromptRegistry:
+    """
+    Loads every prompt in prompts/ once and hands out the text, or system blocks marked for
+    Anthropic prompt caching. Also tallies token usage per prompt, so cache reads and writes can be checked.
+    """
+
+    def __init__(self, directory: Path = PROMPTS_DIR, required=("ocr", "user_interactions")):
+        """
+        Args:
+            directory: Folder of <name>.txt prompt files
+            required: Prompt names that must exist and be non-empty
+
+        Raises:
+            ValueError: If a required prompt is missing or empty
+        """
+        self.directory = Path(directory)
+        self.prompts: Dict[str, str] = {
+            path.stem: path.read_text(encoding="utf-8") for path in sorted(self.directory.glob("*.txt"))
+        }
+        for name in required:
+            if not self.prompts.get(name, "").strip():
+                raise ValueError(f"Prompt '{name}' is missing or empty in {self.directory}")
+
+        # Format: {prompt_name: {"calls": int, "input_tokens": int, ...}}
+        self.usage: Dict[str, Dict[str, int]] = {}
+
+    def get(self, name: str) -> str:
+        return self.prompts[name]
+
+    def cached_system(self, name: str) -> list:
+        """System blocks for the Messages API, with a cache breakpoint after the static prompt."""
+        return [{"type": "text", "text": self.prompts[name], "cache_control": {"type": "ephemeral"}}]
+
+    def record_usage(self, name: str, usage) -> None:
+        """
+        Add one call's token usage to the totals for a prompt.
+
+        Args:
+            usage: Usage from a Messages API response, or the usage dict of an agent ResultMessage
+        """
+        if usage is None:
+            return
+        totals = self.usage.setdefault(name, {"calls": 0, **{field: 0 for field in USAGE_FIELDS}})
+        totals["calls"] += 1
+        call = {}
+        for field in USAGE_FIELDS:
+            value: Optional[int] = usage.get(field) if isinstance(usage, dict) else getattr(usage, field, None)
+            totals[field] += value or 0
+            call[field] = value or 0
+            telemetry.tokens.inc(value or 0, prompt=name, kind=field.removesuffix("_tokens"))
+        telemetry.log("usage", prompt=name, **call)
+
+    def stats(self) -> dict:
+        """Token totals per prompt, with the share of input tokens served from the prompt cache."""
+        stats = {}
+        for name, totals in self.usage.items():
+            input_total = (totals["input_tokens"] + totals["cache_creation_input_tokens"]
+                           + totals["cache_read_input_tokens"])
+            stats[name] = dict(totals, cache_read_ratio=totals["cache_read_input_tokens"] / input_total if input_total else 0.0)
+        return stats
+
+
+registry = PromptRegistry()
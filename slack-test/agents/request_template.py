@@ -0,0 +1,60 @@
+import json
+
+# Slack rejects section text longer than this
+MAX_SECTION_CHARS = 3000
+
+
+def format_currency(value) -> str:
+    try:
+        return f"${float(value):.2f}"
+    except (TypeError, ValueError):
+        return "Unknown"
+
+
+def _receipt_json(receipt: dict) -> str:
+    return json.dumps(receipt, indent=2, ensure_ascii=False)
+
+
+def render_request(receipt: dict, user_id: str, details: str):
+    """
+    Render the reimbursement request posted to the approval channel.
+
+    Args:
+        receipt: Receipt dict from OCR, posted verbatim under RECEIPT DATA
+        user_id: Slack ID of the requester
+        details: 1-3 sentence summary of the purchase and its purpose
+
+    Returns:
+        (text, blocks): mrkdwn fallback text and the equivalent Block Kit blocks
+    """
+    receipt_json = _receipt_json(receipt)
+    summary = (f"*Store:* {receipt.get('store_name', 'Unknown')}   "
+               f"*Date:* {receipt.get('date', 'Unknown')}   "
+               f"*Total:* {format_currency(receipt.get('total'))}")
+    details = details.strip() or "Unknown"
+
+    text = "\n".join([
+        "*PAYMENT REQUEST*",
+        summary,
+        "",
+        "*RECEIPT DATA*",
+        f"```\n{receipt_json}\n```",
+        "",
+        "*USER*",
+        f"<@{user_id}>",
+        "",
+        "*DETAILS*",
+        details,
+    ])
+
+    code_block = f"```\n{receipt_json}\n```"
+    if len(code_block) > MAX_SECTION_CHARS:
+        code_block = f"```\n{receipt_json[:MAX_SECTION_CHARS - 40]}\n…\n```"
+    blocks = [
+        {"type": "header", "text": {"type": "plain_text", "text": "PAYMENT REQUEST"}},
+        {"type": "section", "text": {"type": "mrkdwn", "text": summary}},
+        {"type": "section", "text": {"type": "mrkdwn", "text": "*RECEIPT DATA*\n" + code_block}},
+        {"type": "section", "text": {"type": "mrkdwn", "text": f"*USER*\n<@{user_id}>"}},
+        {"type": "section", "text": {"type": "mrkdwn", "text": ("*DETAILS*\n" + details)[:MAX_SECTION_CHARS]}},
+    ]
+    return text, blocks
@@ -0,0 +1,213 @@
+"""
+Timing spans, counters and a Prometheus-style /metrics endpoint for the reimbursement pipeline.
+
+Spans are correlated through a context that follows the work across tasks and threads: bind user_id and
+event_id once where an event comes in, and every span under it carries them. Each finished span is
+recorded in the reimbursement_stage_seconds histogram and, with TELEMETRY_LOG=1, printed as one JSON line.
+
+Metrics live in this process only; in worker mode each worker keeps its own.
+"""
+import contextvars
+import json
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+TELEMETRY_LOG = os.getenv("TELEMETRY_LOG", "1") == "1"
+# Local port for /metrics; 0 disables the endpoint
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Upper bounds in seconds, from a Slack post to a slow multi-page OCR
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_context: contextvars.ContextVar = contextvars.ContextVar("telemetry_context", default={})
+
+
+def current() -> dict:
+    """The correlation fields bound in this context, e.g. {"user_id": ..., "event_id": ...}."""
+    return _context.get()
+
+
+@contextmanager
+def bind(**fields):
+    """Add correlation fields for everything run inside the block, including tasks and threads it starts."""
+    token = _context.set({**_context.get(), **{key: value for key, value in fields.items() if value is not None}})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def log(event: str, **fields):
+    """Print one structured JSON log line, with the bound correlation fields."""
+    if TELEMETRY_LOG:
+        print(json.dumps({"ts": round(time.time(), 3), "event": event, **current(), **fields}, default=str))
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        return [(self.name, labels, value) for labels, value in self.values.items()]
+
+
+class Gauge:
+    """A value read from a callback at scrape time, such as a live session count."""
+
+    def __init__(self, name: str, help: str, read: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def samples(self):
+        try:
+            return [(self.name, (), float(self.read()))]
+        except Exception as e:
+            print(f"Failed to read gauge {self.name}: {e!r}")
+            return []
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # Format: {labels: [bucket counts..., count, sum]}
+        self.values: Dict[Labels, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        counts = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            counts[index] += 1
+        counts[-2] += 1
+        counts[-1] += value
+
+    def samples(self):
+        samples = []
+        for labels, counts in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", labels + (("le", str(bound)),), cumulative))
+            samples.append((f"{self.name}_bucket", labels + (("le", "+Inf"),), counts[-2]))
+            samples.append((f"{self.name}_count", labels, counts[-2]))
+            samples.append((f"{self.name}_sum", labels, counts[-1]))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.metrics.setdefault(name, Counter(name, help))
+
+    def histogram(self, name: str, help: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, help, buckets))
+
+    def gauge(self, name: str, help: str, read: Callable[[], float]) -> Gauge:
+        """Register (or replace) a gauge read from read() at scrape time."""
+        self.metrics[name] = Gauge(name, help, read)
+        return self.metrics[name]
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics.values():
+            kind = {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}[type(metric)]
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {kind}")
+            for name, labels, value in metric.samples():
+                label_text = ",".join(f'{key}="{_escape(value)}"' for key, value in labels)
+                lines.append(f"{name}{{{label_text}}} {value:g}" if label_text else f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram("reimbursement_stage_seconds", "Duration of each pipeline stage")
+stage_errors = registry.counter("reimbursement_stage_errors_total", "Pipeline stages that raised")
+tokens = registry.counter("reimbursement_tokens_total", "Model tokens by prompt and kind")
+ocr_cache = registry.counter("reimbursement_ocr_cache_total", "OCR cache lookups by result")
+
+
+@contextmanager
+def span(stage: str, **fields):
+    """
+    Time a stage. Works around sync and async code alike:
+
+        with span("agent_query", prompt="user_interactions"):
+            ...
+    """
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException as e:
+        # Cancellation is how timeouts surface, so it counts as an error too
+        status = "error"
+        fields["error"] = repr(e)
+        stage_errors.inc(stage=stage)
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        stage_seconds.observe(duration, stage=stage)
+        log("span", span=stage, duration_ms=round(duration * 1000, 2), status=status, **fields)
+
+
+_server = None
+
+
+async def start_metrics_server(port: Optional[int] = None, host: Optional[str] = None):
+    """Serve GET /metrics on host:port. Does nothing if the port is 0, and only logs if it can't listen."""
+    global _server
+    port = METRICS_PORT if port is None else port
+    if not port or _server is not None:
+        return
+    from aiohttp import web
+
+    async def metrics(request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    server = web.Application()
+    server.add_routes([web.get("/metrics", metrics)])
+    runner = web.AppRunner(server, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host or METRICS_HOST, port).start()
+    except OSError as e:
+        # e.g. the port is taken; the bot runs fine without metrics
+        print(f"Metrics endpoint not started on {host or METRICS_HOST}:{port}: {e}")
+        await runner.cleanup()
+        return
+    _server = runner
+    print(f"Metrics at http://{host or METRICS_HOST}:{port}/metrics")
+
+
+async def stop_metrics_server():
+    global _server
+    if _server is not None:
+        await _server.cleanup()
+        _server = None
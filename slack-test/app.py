@@ -1,8 +1,8 @@
 import os
-import aiohttp
 import logging
 import asyncio
 from pathlib import Path
+from typing import Optional
 from slack_bolt import App
 import json
 from slack_bolt.async_app import AsyncApp
@@ -11,8 +11,21 @@ from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
 import time
 import math
 from session_manager import SessionManager
+from workers import ShardedSessionManager
+from ingest import ingest_files, close_http_session, get_receipt_store
+from store import WatchedThreads
+from jobs import JobQueue, TurnLine
+from streaming import SlackStreamer
+from dispatcher import SlackDispatcher
+from agents.approval import classifier
+from agents import telemetry
 
-manager = SessionManager()
+# Session turns run in this many worker processes, sharded by user; 0 keeps them in this process
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "0"))
+
+# Show DM replies as they are generated by editing a message in place
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "1") == "1"
+STREAM_UPDATE_INTERVAL = float(os.getenv("STREAM_UPDATE_INTERVAL", "1.0"))
 
 # Configure logging to display in terminal
 logging.basicConfig(
@@ -25,204 +38,306 @@ logging.basicConfig(
 # For the companion getting started setup guide, 
 # see: https://slack.dev/bolt-python/tutorial/getting-started 
 
-# Initializes your app with your bot token
-app = AsyncApp(token=os.environ.get("SLACK_BOT_TOKEN"))
-app.watched_messages = {"1763247249.037409": "D09TJQ81D3K"}
+# Built by setup(). Worker processes re-import this module when they are spawned, so importing it
+# must not start anything of its own.
+app: Optional[AsyncApp] = None
+manager = None
+jobs: Optional[JobQueue] = None
+# Jobs run concurrently, so each user's DMs take a turn on arrival to reach their session in order
+turns: Optional[TurnLine] = None
+# Every Slack write goes through here, so it is rate limited and retried in one place
+dispatcher: Optional[SlackDispatcher] = None
+receipts = None
+
+
+def setup() -> AsyncApp:
+    """Build the Slack app and everything its handlers use, and register the handlers. Safe to call again."""
+    global app, manager, jobs, turns, dispatcher, receipts
+    if app is not None:
+        return app
+    manager = ShardedSessionManager(WORKER_PROCESSES) if WORKER_PROCESSES > 0 else SessionManager()
+    jobs = JobQueue(
+        workers=int(os.getenv("JOB_WORKERS", "8")),
+        maxsize=int(os.getenv("JOB_QUEUE_SIZE", "200")),
+    )
+    turns = TurnLine()
+    dispatcher = SlackDispatcher(
+        workers=int(os.getenv("SLACK_DISPATCH_WORKERS", "4")),
+        status_delay=float(os.getenv("SLACK_STATUS_DELAY", "0.5")),
+    )
+    receipts = get_receipt_store()
+
+    # Initializes your app with your bot token
+    app = AsyncApp(token=os.environ.get("SLACK_BOT_TOKEN"))
+    # Approval thread_ts -> requesting user_id, persisted alongside the sessions
+    app.watched_messages = WatchedThreads(manager.store)
+    app.message("ping")(handle_ping_message)
+    app.event("reaction_added")(handle_reactions)
+    app.event("message")(handle_dms)
+
+    manager.eviction_listeners.append(forget_watched_messages)
+    manager.eviction_listeners.append(release_receipts)
+
+    # Read at scrape time from the components' own counters
+    telemetry.registry.gauge("reimbursement_job_queue_depth", "Events waiting for a job worker",
+                             lambda: jobs._queue.qsize())
+    telemetry.registry.gauge("reimbursement_slack_queue_depth", "Slack calls waiting in the dispatcher",
+                             lambda: dispatcher._queue.qsize())
+    telemetry.registry.gauge("reimbursement_receipt_store_bytes", "Bytes of uploaded receipts on disk",
+                             lambda: receipts.stats()["bytes"])
+    if isinstance(manager, SessionManager):
+        telemetry.registry.gauge("reimbursement_active_sessions", "Sessions loaded in memory",
+                                 lambda: len(manager.sessions))
+        telemetry.registry.gauge("reimbursement_agents_in_use", "Agent clients checked out of the pool",
+                                 lambda: manager.pool.in_use)
+    else:
+        # Sessions live in the worker processes; the front process only sees turns in flight
+        telemetry.registry.gauge("reimbursement_worker_turns_in_flight", "Session turns waiting on a worker",
+                                 lambda: len(manager._pending))
+    return app
+
+
+def forget_watched_messages(user_id, reason):
+    """Stop watching approval threads of a session that was evicted."""
+    for thread_ts in app.watched_messages.threads_for(user_id):
+        del app.watched_messages[thread_ts]
+
+
+def release_receipts(user_id, reason):
+    """Let the receipt store clean up the uploads of a session that was evicted."""
+    receipts.finish_session(user_id)
 
 
 # Respond to ping messages
-@app.message("ping")
-async def handle_ping_message(message, say):
+async def handle_ping_message(message, client):
     """Respond to 'ping' messages"""
-    await say("Pong")
+    await dispatcher.call(client, "chat_postMessage", channel=message["channel"], text="Pong")
 
 
 async def download_files(user_id, files, client, logger):
     """
-    Download files from Slack to local downloads directory using aiohttp.
+    Download files from Slack into the receipt store using the shared aiohttp session.
     
     Args:
-        user_id: User ID to prefix file names
+        user_id: User the files are stored under
         files: List of file info dictionaries from Slack event
         client: Slack WebClient instance
         logger: Logger instance
         
     Returns:
-        List of successfully downloaded file names
+        List of successfully downloaded IngestedFile objects
     """
-    # Create downloads directory if it doesn't exist
-    downloads_dir = Path("downloads")
-    downloads_dir.mkdir(exist_ok=True)
+    return await ingest_files(user_id, files, client, logger)
 
-    # Download each file
-    downloaded_files = []
-    headers = {"Authorization": f"Bearer {os.environ.get('SLACK_BOT_TOKEN')}"}
-    
-    async with aiohttp.ClientSession() as session:
-        for file_info in files:
-            file_id = file_info.get("id")
-            file_name = user_id + "_" + file_info.get("name", f"file_{file_id}")
-            
-            try:
-                # Get file info and download URL
-                file_response = await client.files_info(file=file_id)
-                file_data = file_response["file"]
-                
-                # Get the private download URL
-                url_private = file_data.get("url_private")
-                
-                if url_private:
-                    # Download the file asynchronously
-                    async with session.get(url_private, headers=headers) as response:
-                        response.raise_for_status()
-                        
-                        # Save the file
-                        file_path = downloads_dir / file_name
-                        with open(file_path, "wb") as f:
-                            async for chunk in response.content.iter_chunked(8192):
-                                f.write(chunk)
-                        
-                        downloaded_files.append(file_name)
-                        logger.info(f"Downloaded file: {file_name} to {file_path}")
-                else:
-                    logger.warning(f"No download URL found for file {file_id}")
-                    
-            except Exception as e:
-                logger.error(f"Error downloading file {file_id}: {str(e)}")
-    
-    return downloaded_files
 
+async def handle_session_content(user_id, message_content, downloaded_files, logger, on_text=None):
+    """Queue the message for the user's session and return a future of the reply."""
+    # The session manager creates the session if needed and runs one turn per user at a time
+    return await manager.queue_dm_message(user_id, message_content, downloaded_files, on_text)
 
-async def handle_session_content(user_id, message_content, downloaded_file_names, logger):
-    sessions = manager.get_sessions()
-    print("sessions: " + str(sessions))
-    session = sessions.get(user_id)
-    if not session : # 5 minutes
-        manager.create_session(user_id, time.perf_counter())
-    else:
-        print("session found")
-        print("session: " + str(session))
 
-    return await manager.new_dm_message(user_id, message_content, downloaded_file_names)
+async def handle_approval_reply(channel, thread_ts, message_text, client, response=None):
+    """
+    Act on a reply to a watched reimbursement request.
+
+    Args:
+        channel: Channel the request was posted in
+        thread_ts: Timestamp of the request message
+        message_text: The reply, sent to the requester's session to decide whether it approves the request
+        response: Verdict already decided by the caller (e.g. from a reaction), skipping the session
+    """
+    user_id = app.watched_messages[thread_ts]
+    if not manager.has_session(user_id):
+        print("Deleting watched message")
+        del app.watched_messages[thread_ts]
+        return
+
+    with telemetry.bind(user_id=user_id), telemetry.span("approval_reply"):
+        await _act_on_approval(channel, thread_ts, user_id, message_text, client, response)
+
+
+async def _act_on_approval(channel, thread_ts, user_id, message_text, client, response):
+    if response is None:
+        response = await manager.new_thread_message(user_id, message_text)
+    if response["relevant"]:
+        if response["approved"]:
+            await dispatcher.call(
+                client, "chat_postMessage",
+                channel=channel,
+                thread_ts=thread_ts,
+                text="Yay! I'll let the user know that their request has been approved!",
+            )
+        else:
+            await dispatcher.call(
+                client, "chat_postMessage",
+                channel=channel,
+                thread_ts=thread_ts,
+                text="Unfortunate. I will relay this information to the user.",
+            )
+        await dispatcher.call(
+            client, "chat_postMessage",
+            channel=user_id,
+            text=response["message"],
+        )
+        manager.delete_session(user_id)
+        receipts.finish_session(user_id)
+        del app.watched_messages[thread_ts]
 
 
 async def handle_others(event, say, logger, client):
     # Check if the message is in a thread, and the parent message is in watched_messages
     thread_ts = event.get("thread_ts")
     if thread_ts and thread_ts in app.watched_messages:
-        sessions = manager.get_sessions()
-        print(sessions)
-        user_id = app.watched_messages[thread_ts]
-        session = sessions.get(user_id)
-        if not session:
-            print("Deleting watched message")
-            del app.watched_messages[thread_ts]
-            return
-
-        message_text = event.get("text", "")
-        response = await manager.new_thread_message(user_id, message_text)
-        if response["relevant"]:
-            if response["approved"]:
-                await client.chat_postMessage(
-                    channel=thread_ts,
-                    text="Yay! I'll let the user know that their request has been approved!",
-                )
-            else:
-                await client.chat_postMessage(
-                    channel=thread_ts,
-                    text="Unfortunate. I will relay this information to the user.",
-                )
-            await client.chat_postMessage(
-                channel=user_id,
-                text=response["message"],
-            )
-            manager.delete_session(user_id)
-            del app.watched_messages[thread_ts]
+        await handle_approval_reply(event.get("channel"), thread_ts, event.get("text", ""), client)
     else:
         print("Message not part of any watched thread")
 
 
-@app.event("message")
-async def handle_dms(event, say, logger, client):
-    channel_type = event.get("channel_type")
-    if channel_type != "im":
-        await handle_others(event, say, logger, client)
+async def handle_reactions(event, body, logger, client):
+    """Treat a clear approve/deny reaction on a watched request as the approver's reply."""
+    item = event.get("item", {})
+    thread_ts = item.get("ts")
+    if item.get("type") != "message" or thread_ts not in app.watched_messages:
         return
-    
+    # Requesters can't approve (or withdraw) their own request with a reaction
+    if event.get("user") == app.watched_messages[thread_ts]:
+        return
+    response = classifier.classify_reaction(event.get("reaction", ""))
+    if response is None:
+        return
+    try:
+        with telemetry.bind(event_id=body.get("event_id")):
+            await jobs.submit(body.get("event_id"), handle_approval_reply, item.get("channel"), thread_ts, "", client, response)
+    except asyncio.QueueFull:
+        logger.warning(f"Job queue full, dropping reaction on {thread_ts}")
+
+
+async def handle_dms(event, body, say, logger, client):
+    """Hand the event to a background worker so Slack gets its ack right away."""
+    # Re-deliveries of the same event share the event_id (and client_msg_id for user messages)
+    job_id = event.get("client_msg_id") or body.get("event_id")
+    turn = turns.take(event["user"]) if event.get("channel_type") == "im" and event.get("user") else None
+    try:
+        queued = await jobs.submit(job_id, process_message_event, event, say, logger, client, turn)
+        if not queued:
+            logger.info(f"Skipping duplicate event {job_id}")
+            if turn is not None:
+                turn.release()
+    except asyncio.QueueFull:
+        logger.warning(f"Job queue full, dropping event {job_id}")
+        if turn is not None:
+            turn.release()
+        if event.get("channel_type") == "im":
+            await dispatcher.call(client, "chat_postMessage", channel=event.get("channel"),
+                                  text="I'm a little overloaded right now, please send that again in a minute!")
+
+
+async def process_message_event(event, say, logger, client, turn=None):
+    """
+    Args:
+        turn: The sender's place in line from turns, taken when the event arrived. Taken here if not given.
+    """
+    # Every span logged while handling the event carries these
+    with telemetry.bind(event_id=event.get("client_msg_id") or event.get("ts"), user_id=event.get("user")):
+        channel_type = event.get("channel_type")
+        if channel_type != "im":
+            await handle_others(event, say, logger, client)
+            return
+        turn = turn or turns.take(event.get("user"))
+        try:
+            with telemetry.span("handle_event"):
+                await _process_dm_event(event, logger, client, turn)
+        finally:
+            turn.release()
+
+
+async def _process_dm_event(event, logger, client, turn):
     # Set thinking status
     channel = event.get("channel")
     thread_ts = event.get("thread_ts") or event.get("ts")  # Use message timestamp as thread_ts for DMs
-    try:
-        await client.assistant_threads_setStatus(
-            channel_id=channel,
-            thread_ts=thread_ts,
-            status="thinking...",
-            loading_messages=[
-                "Teaching the hamsters to type faster…",
-                "Untangling the internet cables…",
-                "Consulting the office goldfish…",
-                "Polishing up the response just for you…",
-                "Convincing the AI to stop overthinking…",
-            ],
-        )
-    except Exception as e:
-        logger.warning(f"Failed to set thinking status: {str(e)}")
+    dispatcher.set_status(
+        client, channel, thread_ts, "thinking...",
+        loading_messages=[
+            "Teaching the hamsters to type faster…",
+            "Untangling the internet cables…",
+            "Consulting the office goldfish…",
+            "Polishing up the response just for you…",
+            "Convincing the AI to stop overthinking…",
+        ],
+    )
     
     # Only handle file_share subtype (file uploads)
-    downloaded_file_names = []
+    downloaded_files = []
     user_id = event.get("user")
-
-    subtype = event.get("subtype")
-    if subtype == "file_share":
-        files = event.get("files", [])
-        logger.info(f"Received DM file upload from {user_id}: {files}")
-        downloaded_file_names = await download_files(user_id, files, client, logger)
-        print("downloaded_file_names: " + str(downloaded_file_names))
-
     message_text = event.get("text", "")
-    responses = await handle_session_content(user_id, message_text, downloaded_file_names, logger)
+    streamer = None
+    on_text = None
+    if STREAM_RESPONSES:
+        streamer = SlackStreamer(dispatcher.bind(client), channel, min_interval=STREAM_UPDATE_INTERVAL, logger=logger)
+        on_text = lambda text: streamer.update(text.replace("**", "*"))
+
+    # Waits for the user's earlier messages to be queued, so a text sent right after an upload
+    # can't overtake the upload's download
+    async with turn:
+        subtype = event.get("subtype")
+        if subtype == "file_share":
+            files = event.get("files", [])
+            logger.info(f"Received DM file upload from {user_id}: {files}")
+            downloaded_files = await download_files(user_id, files, client, logger)
+            print("downloaded_files: " + str([f.name for f in downloaded_files]))
+        reply = await handle_session_content(user_id, message_text, downloaded_files, logger, on_text)
     try:
-        if isinstance(responses, list):
-            for response in responses:
-                content = response.get("content").replace("**", "*")
-                if response and response.get("location") == "dm":
-                    await say(content)
-                elif response and response.get("location") == "request":
-                    message = await client.chat_postMessage(
-                        channel="C09T45YDXAA",
-                        text=content,
-                    )
-                    app.watched_messages[message["ts"]] = user_id
-        else:
-            response = responses
+        responses = await reply
+    except Exception as e:
+        # e.g. the worker running the session died; the user still hears back
+        logger.warning(f"Failed to process message from {user_id}: {e!r}")
+        responses = [{"location": "dm", "content": "Sorry, something went wrong on my end. Could you send that again?"}]
+    # None means this message was merged into a later one, which carries the reply
+    if not isinstance(responses, list):
+        responses = [responses] if responses else []
+    try:
+        for response in responses:
             content = response.get("content").replace("**", "*")
-            if response and response.get("location") == "dm":
-                await say(content)
-            elif response and response.get("location") == "request":
-                message = await client.chat_postMessage(
+            if response.get("location") == "dm":
+                # The first DM reply replaces the message streamed while it was generated
+                if streamer is not None:
+                    streamed, streamer = await streamer.finish(content), None
+                    if streamed:
+                        continue
+                await dispatcher.call(client, "chat_postMessage", channel=channel, text=content)
+            elif response.get("location") == "request":
+                message = await dispatcher.call(
+                    client, "chat_postMessage",
                     channel="C09T45YDXAA",
                     text=content,
+                    blocks=response.get("blocks"),
                 )
                 app.watched_messages[message["ts"]] = user_id
 
     except Exception as e:
         logger.warning(f"Failed to send response: {str(e)}")
     
-    # Clear thinking status after processing is complete
-    try:
-        await client.assistant_threads_setStatus(
-            channel_id=channel,
-            thread_ts=thread_ts,
-            status="",
-        )
-    except Exception as e:
-        logger.warning(f"Failed to clear thinking status: {str(e)}")
+    # Clear thinking status after processing is complete; skipped if it was never shown
+    dispatcher.set_status(client, channel, thread_ts, "")
 
 
 # Start your app
 async def main():
-    handler = AsyncSocketModeHandler(app, os.environ["SLACK_APP_TOKEN"])
-    await handler.start_async()
+    handler = AsyncSocketModeHandler(setup(), os.environ["SLACK_APP_TOKEN"])
+    await manager.start()
+    await receipts.start()
+    jobs.start()
+    dispatcher.start()
+    try:
+        await telemetry.start_metrics_server()
+        await handler.start_async()
+    finally:
+        await telemetry.stop_metrics_server()
+        await jobs.close()
+        await dispatcher.close()
+        await manager.close()
+        await receipts.close()
+        await close_http_session()
 
 if __name__ == "__main__":
     asyncio.run(main())
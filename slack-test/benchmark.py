@@ -0,0 +1,463 @@
+"""
+End-to-end load and latency benchmark with local stand-ins for Slack and Anthropic.
+
+    python benchmark.py --users 50 --ramp 10
+
+Drives N simulated users through the whole flow in app.py: uploading a receipt, answering the Phase 2
+question, and an approver replying in the request thread. Slack is a fake Web API client plus a local
+file server for uploads; OCR calls go to a local Messages API stand-in, and agent queries to fake agent
+clients in the pool. Every backend sleeps for a configurable, jittered latency and returns scripted replies.
+Slack rate limits and all local work (pre-screen, preprocessing, sessions, store) are the real ones.
+
+Reports throughput, p50/p95/p99 per stage and peak memory per session, appends the run to
+benchmarks/results.jsonl, and compares it with the last run that used the same settings.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+STAGES = ("receipt", "phase2", "approval")
+APPROVAL_CHANNEL = "C09T45YDXAA"
+PURPOSE_TEXT = "It was a team lunch for the Locus onboarding project."
+
+OCR_REPLY = {
+    "is_receipt": True,
+    "too_blurry": False,
+    "items": [{"name": "Burrito bowl", "price": 12.5}, {"name": "Lemonade", "price": 3.75}],
+    "date": "2025-10-04",
+    "location": "San Francisco, CA",
+    "store_name": "Bench Burrito",
+    "total": 16.25,
+}
+NEED_INFO_REPLY = {"status": "need_info", "missing_fields": ["business_purpose"],
+                   "message": "Thanks! What was the *business purpose* of this purchase? For example: team lunch for project X."}
+COMPLETE_REPLY = {"status": "complete", "missing_fields": [],
+                  "details": "Lunch for the team. Business purpose: Locus onboarding project."}
+APPROVAL_REPLY = {"relevant": True, "approved": True, "message": "Your reimbursement was approved!"}
+
+
+class Latency:
+    """A mean delay in seconds, with normally distributed jitter as a fraction of the mean."""
+
+    def __init__(self, mean: float, jitter: float):
+        self.mean = mean
+        self.jitter = jitter
+
+    def sample(self) -> float:
+        return max(0.0, random.gauss(self.mean, self.mean * self.jitter))
+
+    async def wait(self):
+        await asyncio.sleep(self.sample())
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile; 0.0 for no values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+def receipt_image(index: int) -> bytes:
+    """A synthetic receipt photo, unique per user so nothing is served from the OCR cache."""
+    from PIL import Image, ImageDraw
+
+    image = Image.new("L", (700, 1100), 255)
+    draw = ImageDraw.Draw(image)
+    rng = random.Random(index)
+    draw.text((40, 20), f"BENCH BURRITO  ORDER #{index:06d}", fill=0)
+    for y in range(60, 1040, 28):
+        draw.text((40, y), f"ITEM {rng.randint(100, 999)} ........ ${rng.randint(1, 40)}.{rng.randint(0, 99):02d}   " * 2, fill=0)
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+# Stand-ins
+
+class FakeSlackClient:
+    """The Web API methods app.py calls, each taking slack_latency and recording what was sent."""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+        # Format: {channel: [text, ...]}
+        self.messages: Dict[str, List[str]] = {}
+        self._ts = 0
+
+    def _next_ts(self) -> str:
+        self._ts += 1
+        return f"{1700000000 + self._ts}.000000"
+
+    async def _call(self, method: str):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        await self.latency.wait()
+
+    async def chat_postMessage(self, channel, text="", **kwargs):
+        await self._call("chat_postMessage")
+        self.messages.setdefault(channel, []).append(text)
+        return {"ok": True, "channel": channel, "ts": self._next_ts()}
+
+    async def chat_update(self, channel, ts, text="", **kwargs):
+        await self._call("chat_update")
+        return {"ok": True, "channel": channel, "ts": ts}
+
+    async def assistant_threads_setStatus(self, **kwargs):
+        await self._call("assistant_threads_setStatus")
+        return {"ok": True}
+
+    async def files_info(self, file):
+        await self._call("files_info")
+        return {"ok": True, "file": {}}
+
+
+class _ReadyTransport:
+    def is_ready(self) -> bool:
+        return True
+
+
+class FakeAgentClient:
+    """Stands in for ClaudeSDKClient: answers Phase 2 and approval prompts from a script, streaming the text."""
+
+    def __init__(self, options, latency: Latency, chunk_chars: int = 24):
+        self.latency = latency
+        self.chunk_chars = chunk_chars
+        self._transport = _ReadyTransport()
+        self._reply: Optional[str] = None
+
+    async def connect(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+    @staticmethod
+    def script(prompt: str) -> str:
+        from agents.phase2 import PHASE2_INSTRUCTION
+
+        if PHASE2_INSTRUCTION in prompt:
+            return json.dumps(COMPLETE_REPLY if PURPOSE_TEXT in prompt else NEED_INFO_REPLY)
+        return json.dumps(APPROVAL_REPLY)
+
+    async def query(self, prompt: str):
+        self._reply = None if prompt == "/clear" else self.script(prompt)
+
+    async def receive_response(self):
+        from claude_agent_sdk import AssistantMessage, ResultMessage, StreamEvent, TextBlock
+
+        reply = self._reply
+        if reply:
+            chunks = [reply[i:i + self.chunk_chars] for i in range(0, len(reply), self.chunk_chars)]
+            # The sampled latency is spread over the chunks, like tokens arriving over time
+            delay = self.latency.sample() / len(chunks)
+            for chunk in chunks:
+                await asyncio.sleep(delay)
+                yield StreamEvent(uuid="bench", session_id="bench",
+                                  event={"type": "content_block_delta", "delta": {"type": "text_delta", "text": chunk}})
+            yield AssistantMessage(content=[TextBlock(reply)], model="bench")
+        yield ResultMessage(subtype="success", duration_ms=0, duration_api_ms=0, is_error=False, num_turns=1,
+                            session_id="bench", usage={"input_tokens": 1000, "output_tokens": len(reply or "") // 4})
+
+
+class StandIn:
+    """Local HTTP server for Slack file downloads and the Messages API used by OCR."""
+
+    def __init__(self, ocr_latency: Latency):
+        self.ocr_latency = ocr_latency
+        self.files: Dict[str, bytes] = {}
+        self.ocr_calls = 0
+        self.url = ""
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _file(self, request):
+        return web.Response(body=self.files[request.match_info["name"]], content_type="image/png")
+
+    async def _messages(self, request):
+        await request.read()
+        self.ocr_calls += 1
+        await self.ocr_latency.wait()
+        return web.json_response({
+            "id": f"msg_bench_{self.ocr_calls}", "type": "message", "role": "assistant", "model": "bench",
+            "stop_reason": "end_turn", "stop_sequence": None,
+            "content": [{"type": "text", "text": json.dumps(OCR_REPLY)}],
+            "usage": {"input_tokens": 1500, "output_tokens": 120,
+                      "cache_creation_input_tokens": 0, "cache_read_input_tokens": 900},
+        })
+
+    async def start(self):
+        server = web.Application(client_max_size=64 * 1024 * 1024)
+        server.add_routes([web.get("/files/{name}", self._file), web.post("/v1/messages", self._messages)])
+        self._runner = web.AppRunner(server, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+# The run
+
+def _rss_bytes() -> int:
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+async def _simulate_user(bench, index: int, start_delay: float, think_time: float, timings: Dict[str, List[float]]):
+    app = bench["app"]
+    slack: FakeSlackClient = bench["slack"]
+    logger = logging.getLogger("benchmark")
+    user_id = f"UBENCH{index:05d}"
+    channel = f"DBENCH{index:05d}"
+    name = f"{index}.png"
+
+    async def stage(stage_name: str, event: dict):
+        started = time.perf_counter()
+        await app.process_message_event(event, None, logger, slack)
+        timings[stage_name].append(time.perf_counter() - started)
+
+    await asyncio.sleep(start_delay)
+    await stage("receipt", {
+        "type": "message", "subtype": "file_share", "channel_type": "im", "channel": channel, "user": user_id,
+        "text": "", "ts": f"{index}.1",
+        "files": [{"id": f"FBENCH{index}", "name": "receipt.png", "size": len(bench["stand_in"].files[name]),
+                   "url_private": f"{bench['stand_in'].url}/files/{name}"}],
+    })
+    await asyncio.sleep(think_time)
+    await stage("phase2", {"type": "message", "channel_type": "im", "channel": channel, "user": user_id,
+                           "text": PURPOSE_TEXT, "ts": f"{index}.2"})
+    threads = app.app.watched_messages.threads_for(user_id)
+    if not threads:
+        raise RuntimeError(f"{user_id} finished Phase 2 without a request being posted")
+    bench["peak_sessions"] = max(bench["peak_sessions"], len(getattr(app.manager, "sessions", ())))
+
+    await asyncio.sleep(think_time)
+    await stage("approval", {"type": "message", "channel_type": "channel", "channel": APPROVAL_CHANNEL,
+                             "user": "UBENCHAPPROVER", "text": "Approved!", "thread_ts": threads[0], "ts": f"{index}.3"})
+    if not any("approved" in text.lower() for text in slack.messages.get(user_id, [])):
+        raise RuntimeError(f"{user_id} was never told about the approval")
+
+
+async def _sample_memory(bench, interval: float = 0.5):
+    while True:
+        stats = bench["app"].manager.stats()
+        bench["peak_bytes_per_session"] = max(bench["peak_bytes_per_session"], stats.get("approx_bytes_per_session", 0))
+        await asyncio.sleep(interval)
+
+
+async def run(users: int, ramp: float, think_time: float, ocr_latency: float, agent_latency: float,
+              slack_latency: float, jitter: float, seed: int) -> dict:
+    """Run one benchmark and return its report. Must run in a fresh process, since it configures app.py."""
+    random.seed(seed)
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    stand_in = StandIn(Latency(ocr_latency, jitter))
+    await stand_in.start()
+
+    # app.py and the OCR client read these at import time
+    os.environ.update(
+        ANTHROPIC_BASE_URL=stand_in.url,
+        ANTHROPIC_API_KEY="bench",
+        SLACK_BOT_TOKEN="xoxb-bench",
+        SESSION_STORE_PATH=os.path.join(workdir, "sessions.sqlite3"),
+        RECEIPT_STORE_DIR=os.path.join(workdir, "downloads"),
+        OCR_CACHE_PATH="",
+        WORKER_PROCESSES="0",
+    )
+    import app
+    app.setup()
+    from agents.main_agent import build_options
+    from agents.pool import AgentPool
+    from ingest import close_http_session
+
+    agent = Latency(agent_latency, jitter)
+    app.manager.pool = AgentPool(build_options, size=int(os.getenv("AGENT_POOL_SIZE", "4")),
+                                 client_factory=lambda options: FakeAgentClient(options, agent))
+    slack = FakeSlackClient(Latency(slack_latency, jitter))
+    for index in range(users):
+        stand_in.files[f"{index}.png"] = receipt_image(index)
+
+    bench = {"app": app, "slack": slack, "stand_in": stand_in, "peak_sessions": 0, "peak_bytes_per_session": 0}
+    timings: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+    rss_before = _rss_bytes()
+    await app.manager.start()
+    app.dispatcher.start()
+    sampler = asyncio.create_task(_sample_memory(bench))
+
+    started = time.perf_counter()
+    outcomes = await asyncio.gather(
+        *(_simulate_user(bench, index, ramp * index / users, think_time, timings) for index in range(users)),
+        return_exceptions=True,
+    )
+    wall = time.perf_counter() - started
+
+    sampler.cancel()
+    await app.dispatcher.close()
+    await app.manager.close()
+    await close_http_session()
+    await stand_in.close()
+
+    failures = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+    completed = users - len(failures)
+    rss_growth = max(0, _rss_bytes() - rss_before)
+    return {
+        "users": users,
+        "completed": completed,
+        "failed": len(failures),
+        "errors": sorted({repr(failure) for failure in failures})[:5],
+        "wall_seconds": wall,
+        "throughput_flows_per_s": completed / wall if wall else 0.0,
+        "stages": {
+            stage: {
+                "count": len(values),
+                "mean": sum(values) / len(values) if values else 0.0,
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+            }
+            for stage, values in timings.items()
+        },
+        "memory": {
+            "peak_live_sessions": bench["peak_sessions"],
+            "peak_bytes_per_session": bench["peak_bytes_per_session"],
+            "rss_growth_bytes": rss_growth,
+            "rss_growth_per_user": rss_growth / users if users else 0,
+        },
+        "backend_calls": {"ocr": stand_in.ocr_calls, "agent_clients": app.manager.pool.created, **slack.calls},
+        "dispatcher": {method: {"calls": metrics["calls"], "rate_limited": metrics["rate_limited"],
+                                "wait_avg": metrics["wait_total"] / metrics["calls"] if metrics["calls"] else 0.0,
+                                "wait_max": metrics["wait_max"]}
+                       for method, metrics in app.dispatcher.methods.items()},
+    }
+
+
+# Results
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_run(results_path: Path, config: dict) -> Optional[dict]:
+    """The most recent stored run with exactly the same settings."""
+    if not results_path.exists():
+        return None
+    previous = None
+    for line in results_path.read_text(encoding="utf-8").splitlines():
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if record.get("config") == config:
+            previous = record
+    return previous
+
+
+def compare(report: dict, previous: dict, threshold: float) -> List[str]:
+    """
+    Regressions against a previous run: a stage p95 or p99 that grew, or throughput that fell, by more
+    than threshold (a fraction).
+    """
+    regressions = []
+    for stage, current in report["stages"].items():
+        before = previous["report"]["stages"].get(stage)
+        if not before:
+            continue
+        for metric in ("p95", "p99"):
+            if before[metric] and current[metric] > before[metric] * (1 + threshold):
+                regressions.append(f"{stage} {metric} {before[metric]:.3f}s -> {current[metric]:.3f}s")
+    before = previous["report"]["throughput_flows_per_s"]
+    if before and report["throughput_flows_per_s"] < before * (1 - threshold):
+        regressions.append(f"throughput {before:.2f} -> {report['throughput_flows_per_s']:.2f} flows/s")
+    return regressions
+
+
+def print_report(report: dict):
+    print(f"\n{report['completed']}/{report['users']} flows in {report['wall_seconds']:.1f}s "
+          f"({report['throughput_flows_per_s']:.2f} flows/s)")
+    print(f"{'stage':<10}{'count':>7}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for stage, metrics in report["stages"].items():
+        print(f"{stage:<10}{metrics['count']:>7}" + "".join(f"{metrics[key]:>8.3f}s" for key in ("mean", "p50", "p95", "p99")))
+    memory = report["memory"]
+    print(f"peak live sessions: {memory['peak_live_sessions']}, ~{memory['peak_bytes_per_session'] / 1024:.1f} KiB "
+          f"per session, RSS growth {memory['rss_growth_bytes'] / 2**20:.1f} MiB "
+          f"({memory['rss_growth_per_user'] / 1024:.1f} KiB per user)")
+    print(f"backend calls: {report['backend_calls']}")
+    for error in report["errors"]:
+        print(f"failure: {error}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end load and latency benchmark with local stand-ins.")
+    parser.add_argument("--users", type=int, default=20, help="Simulated users, each running the full flow once")
+    parser.add_argument("--ramp", type=float, default=5.0, help="Seconds over which users start")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Seconds a user waits between steps")
+    parser.add_argument("--ocr-latency", type=float, default=1.5, help="Mean seconds per OCR call")
+    parser.add_argument("--agent-latency", type=float, default=2.0, help="Mean seconds per agent reply")
+    parser.add_argument("--slack-latency", type=float, default=0.05, help="Mean seconds per Slack API call")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Latency standard deviation, as a fraction of the mean")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--results", default=str(Path(__file__).parent / "benchmarks" / "results.jsonl"),
+                        help="JSONL file runs are appended to and compared against")
+    parser.add_argument("--label", default="", help="Free-form note stored with the run")
+    parser.add_argument("--regression-threshold", type=float, default=0.1)
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 on a regression")
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's own output during the run")
+    args = parser.parse_args(argv)
+
+    config = {
+        "users": args.users, "ramp": args.ramp, "think_time": args.think_time, "ocr_latency": args.ocr_latency,
+        "agent_latency": args.agent_latency, "slack_latency": args.slack_latency, "jitter": args.jitter,
+        "seed": args.seed,
+        # Settings read from the environment change the results too
+        "env": {name: os.getenv(name) for name in ("AGENT_POOL_SIZE", "OCR_CONCURRENCY", "MESSAGE_COALESCE_WINDOW",
+                                                   "STREAM_RESPONSES", "SLACK_STATUS_DELAY", "PRESCREEN_ENABLED")},
+    }
+    logging.getLogger("benchmark").setLevel(logging.ERROR)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+        report = asyncio.run(run(args.users, args.ramp, args.think_time, args.ocr_latency, args.agent_latency,
+                                 args.slack_latency, args.jitter, args.seed))
+    print_report(report)
+
+    results_path = Path(args.results)
+    previous = previous_run(results_path, config)
+    results_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(results_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"timestamp": time.time(), "commit": _commit(), "label": args.label,
+                            "config": config, "report": report}) + "\n")
+
+    if previous is None:
+        print(f"\nNo earlier run with these settings in {results_path}")
+        return
+    regressions = compare(report, previous, args.regression_threshold)
+    print(f"\nCompared with run at commit {previous.get('commit')}: "
+          + ("no regressions" if not regressions else f"{len(regressions)} regressions"))
+    for regression in regressions:
+        print(f"  REGRESSION {regression}")
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+import asyncio
+import itertools
+import time
+from typing import Dict, Optional, Tuple
+
+from slack_sdk.errors import SlackApiError
+
+from agents import telemetry
+
+# Priorities, lowest value goes first: replies the user is waiting for, then edits of
+# streamed messages, then "thinking..." status updates
+REPLY = 0
+UPDATE = 1
+STATUS = 2
+
+# Web API method -> (requests per minute, burst), matching Slack's rate limit tiers
+# (Tier 2: 20+/min, Tier 3: 50+/min, Tier 4: 100+/min; chat.postMessage: ~1/s per channel)
+RATE_LIMITS = {
+    "chat_postMessage": (60, 3),
+    "chat_update": (50, 5),
+    "assistant_threads_setStatus": (50, 5),
+    "reactions_add": (50, 5),
+}
+DEFAULT_RATE_LIMIT = (20, 3)
+
+# Methods limited per channel rather than per workspace
+PER_CHANNEL = {"chat_postMessage", "chat_update"}
+
+DEFAULT_PRIORITY = {
+    "chat_update": UPDATE,
+    "assistant_threads_setStatus": STATUS,
+}
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, burst: int):
+        self.rate = per_minute / 60
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        # Set from a 429's Retry-After; nothing is sent before then
+        self.blocked_until = 0.0
+
+    def reserve(self) -> float:
+        """
+        Take the next token, even one that hasn't refilled yet.
+
+        Returns:
+            Seconds until the call may be sent: 0 if a token was free, else until its token refills or the
+            bucket's Retry-After pause ends
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(-self.tokens / self.rate if self.tokens < 0 else 0.0, self.blocked_until - now, 0.0)
+
+
+class SlackDispatcher:
+    """
+    Single outbound path for Slack Web API writes.
+
+    Calls are queued by priority and sent by a few worker tasks. Each call takes a token from the bucket
+    for its method (and channel, for chat methods) so bursts stay under Slack's limits instead of
+    failing; a call whose token isn't there yet is set aside until it is, so rate limit waits never
+    hold up calls to other buckets. A 429 pauses that bucket for Retry-After seconds and the call is retried.
+
+    Status updates are fire-and-forget and delayed by status_delay: a turn that finishes sooner never
+    shows a status, and its set/clear pair is dropped without any API call.
+    """
+
+    def __init__(self, workers: int = 4, max_retries: int = 3, status_delay: float = 0.5):
+        """
+        Args:
+            workers: Number of sender tasks, i.e. max Slack calls in flight
+            max_retries: Retries of a call that was rate limited before giving up
+            status_delay: Seconds a status update waits before it is queued
+        """
+        self.workers = workers
+        self.max_retries = max_retries
+        self.status_delay = status_delay
+
+        self._queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self._order = itertools.count()
+        self._buckets: Dict[Tuple[str, Optional[str]], TokenBucket] = {}
+        self._tasks = []
+        # Calls waiting out a rate limit before going back in the queue: {timer: the call's future}
+        self._parked: Dict[asyncio.TimerHandle, asyncio.Future] = {}
+        # (channel, thread_ts) -> delayed status update not queued yet
+        self._pending_status: Dict[Tuple[str, str], asyncio.TimerHandle] = {}
+        # (channel, thread_ts) -> last status queued for sending
+        self._shown_status: Dict[Tuple[str, str], str] = {}
+
+        # Format: {method: {"calls": int, "rate_limited": int, "failed": int, "wait_total": float, "wait_max": float}}
+        self.methods: Dict[str, dict] = {}
+        self.status_coalesced = 0
+
+    def start(self):
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._work()))
+
+    async def close(self):
+        for handle in self._pending_status.values():
+            handle.cancel()
+        self._pending_status.clear()
+        for handle, future in self._parked.items():
+            handle.cancel()
+            future.cancel()
+        self._parked.clear()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _bucket(self, method: str, channel: Optional[str]) -> TokenBucket:
+        key = (method, channel if method in PER_CHANNEL else None)
+        if key not in self._buckets:
+            self._buckets[key] = TokenBucket(*RATE_LIMITS.get(method, DEFAULT_RATE_LIMIT))
+        return self._buckets[key]
+
+    def _enqueue(self, client, method: str, kwargs: dict, priority: Optional[int] = None) -> asyncio.Future:
+        if not self._tasks:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        priority = DEFAULT_PRIORITY.get(method, REPLY) if priority is None else priority
+        # The caller's correlation fields ride along, so the post's span is logged against its event
+        # The last two fields are the attempt number and whether the call already holds a rate limit token
+        self._queue.put_nowait((priority, next(self._order), time.perf_counter(), telemetry.current(),
+                                client, method, kwargs, future, 0, False))
+        return future
+
+    async def call(self, client, method: str, priority: Optional[int] = None, **kwargs):
+        """
+        Send client.<method>(**kwargs) through the queue and wait for the response.
+
+        Args:
+            client: Slack AsyncWebClient
+            method: Web API method name as on the client, e.g. "chat_postMessage"
+            priority: REPLY, UPDATE or STATUS; defaults by method
+
+        Raises:
+            SlackApiError: If Slack rejected the call, or it was still rate limited after max_retries
+        """
+        return await self._enqueue(client, method, kwargs, priority)
+
+    def bind(self, client) -> "DispatchedClient":
+        """A stand-in for client whose API calls go through this dispatcher."""
+        return DispatchedClient(self, client)
+
+    def set_status(self, client, channel: str, thread_ts: str, status: str, **kwargs):
+        """
+        Set (or, with an empty status, clear) an assistant thread status without waiting for it.
+
+        Replaces any update for the same thread that has not been queued yet. A clear that only
+        cancels a status that was never shown is dropped entirely.
+        """
+        key = (channel, thread_ts)
+        pending = self._pending_status.pop(key, None)
+        if pending is not None:
+            pending.cancel()
+            self.status_coalesced += 1
+        if not status and not self._shown_status.get(key):
+            # Nothing was shown, so there is nothing to clear
+            self._shown_status.pop(key, None)
+            self.status_coalesced += 1
+            return
+
+        def send():
+            self._pending_status.pop(key, None)
+            if status:
+                self._shown_status[key] = status
+            else:
+                self._shown_status.pop(key, None)
+            future = self._enqueue(client, "assistant_threads_setStatus",
+                                   dict(channel_id=channel, thread_ts=thread_ts, status=status, **kwargs))
+            future.add_done_callback(_log_status_failure)
+
+        if status and self.status_delay > 0:
+            self._pending_status[key] = asyncio.get_running_loop().call_later(self.status_delay, send)
+        else:
+            send()
+
+    def _park(self, delay: float, item: tuple):
+        """Put a call back in the queue after delay seconds, without holding a worker meanwhile."""
+        def requeue():
+            del self._parked[handle]
+            self._queue.put_nowait(item)
+
+        handle = asyncio.get_running_loop().call_later(delay, requeue)
+        self._parked[handle] = item[7]
+
+    async def _work(self):
+        while True:
+            item = await self._queue.get()
+            priority, order, queued_at, context, client, method, kwargs, future, attempt, reserved = item
+            metrics = self.methods.setdefault(method, {"calls": 0, "rate_limited": 0, "failed": 0,
+                                                       "wait_total": 0.0, "wait_max": 0.0})
+            try:
+                if future.cancelled():
+                    continue
+                bucket = self._bucket(method, kwargs.get("channel"))
+                if not reserved:
+                    delay = bucket.reserve()
+                    if delay > 0:
+                        # Rate limited: the call waits outside the queue with its token reserved, and
+                        # keeps its place among calls of the same priority when it comes back
+                        self._park(delay, item[:-1] + (True,))
+                        continue
+                sent_at = time.perf_counter()
+                try:
+                    with telemetry.bind(**context), telemetry.span("slack_post", method=method):
+                        response = await getattr(client, method)(**kwargs)
+                except SlackApiError as e:
+                    if e.response.status_code != 429:
+                        raise
+                    metrics["rate_limited"] += 1
+                    if attempt == self.max_retries:
+                        raise
+                    retry_after = float(e.response.headers.get("Retry-After", 1))
+                    bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + retry_after)
+                    print(f"Slack rate limited {method}, retrying in {retry_after}s")
+                    self._park(retry_after, item[:-2] + (attempt + 1, False))
+                    continue
+                # Time spent queued and held back by rate limits, not the API call itself
+                waited = sent_at - queued_at
+                metrics["calls"] += 1
+                metrics["wait_total"] += waited
+                metrics["wait_max"] = max(metrics["wait_max"], waited)
+                if not future.cancelled():
+                    future.set_result(response)
+            except Exception as e:
+                metrics["failed"] += 1
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            "depth": self._queue.qsize(),
+            "parked": len(self._parked),
+            "workers": len(self._tasks),
+            "status_coalesced": self.status_coalesced,
+            "methods": {
+                method: dict(metrics, wait_avg=metrics["wait_total"] / metrics["calls"] if metrics["calls"] else 0.0)
+                for method, metrics in self.methods.items()
+            },
+        }
+
+
+def _log_status_failure(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Failed to update thinking status: {future.exception()!r}")
+
+
+class DispatchedClient:
+    """Forwards client.<method>(**kwargs) calls to SlackDispatcher.call, e.g. for SlackStreamer."""
+
+    def __init__(self, dispatcher: SlackDispatcher, client):
+        self._dispatcher = dispatcher
+        self._client = client
+
+    def __getattr__(self, method: str):
+        async def call(**kwargs):
+            return await self._dispatcher.call(self._client, method, **kwargs)
+        return call
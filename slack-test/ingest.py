@@ -0,0 +1,163 @@
+import os
+import asyncio
+import hashlib
+import aiohttp
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+from agents import telemetry
+from receipt_store import ReceiptStore, map_file
+
+# Files larger than this are rejected while streaming
+MAX_FILE_BYTES = int(os.getenv("INGEST_MAX_FILE_BYTES", str(20 * 1024 * 1024)))
+# Files larger than this are streamed straight to disk instead of also being kept in memory
+SPILL_BYTES = int(os.getenv("INGEST_SPILL_BYTES", str(5 * 1024 * 1024)))
+# Max open connections to Slack's file servers, shared by every download
+MAX_CONNECTIONS = int(os.getenv("INGEST_MAX_CONNECTIONS", "16"))
+
+CHUNK_SIZE = 64 * 1024
+
+_receipts: Optional[ReceiptStore] = None
+_http_session: Optional[aiohttp.ClientSession] = None
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+@dataclass
+class IngestedFile:
+    """
+    A file downloaded from Slack, stored in the receipt store under key (the SHA-256 of its bytes).
+    Small files are also kept in memory (data); large ones are memory-mapped from path when read.
+    """
+    name: str
+    size: int
+    data: Optional[bytes] = None
+    path: Optional[Path] = None
+    key: Optional[str] = None
+
+    def read_bytes(self) -> bytes:
+        if self.data is not None:
+            return self.data
+        return map_file(self.path)
+
+
+def get_receipt_store() -> ReceiptStore:
+    """
+    Return the process-wide receipt store, creating it on first use. Every download is kept there, by
+    content hash, until its session finishes and the quota or retention runs out.
+    """
+    global _receipts
+    if _receipts is None:
+        _receipts = ReceiptStore(
+            root=os.getenv("RECEIPT_STORE_DIR", "downloads"),
+            max_bytes=int(os.getenv("RECEIPT_STORE_MAX_BYTES", str(1024 ** 3))),
+            retention=float(os.getenv("RECEIPT_STORE_RETENTION", str(24 * 3600))),
+            compact_interval=float(os.getenv("RECEIPT_STORE_COMPACT_INTERVAL", "600")),
+        )
+    return _receipts
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Return the process-wide HTTP session, creating it on first use."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, keepalive_timeout=60)
+        _http_session = aiohttp.ClientSession(
+            connector=connector,
+            headers={"Authorization": f"Bearer {os.environ.get('SLACK_BOT_TOKEN')}"},
+        )
+    return _http_session
+
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
+async def _stream_to_file(user_id: str, name: str, url: str) -> IngestedFile:
+    buffer = bytearray()
+    digest = hashlib.sha256()
+    spill = None
+    receipts = get_receipt_store()
+    spill_path = receipts.temp_path()
+    size = 0
+    try:
+        async with get_http_session().get(url) as response:
+            response.raise_for_status()
+            if (response.content_length or 0) > MAX_FILE_BYTES:
+                raise FileTooLarge(f"{name} is {response.content_length} bytes, limit is {MAX_FILE_BYTES}")
+
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_FILE_BYTES:
+                    raise FileTooLarge(f"{name} is over the {MAX_FILE_BYTES} byte limit")
+                digest.update(chunk)
+                if spill is None and size > SPILL_BYTES:
+                    spill = open(spill_path, "wb")
+                    spill.write(buffer)
+                    buffer = None
+                if spill is not None:
+                    spill.write(chunk)
+                else:
+                    buffer.extend(chunk)
+    except BaseException:
+        if spill is not None:
+            spill.close()
+            spill_path.unlink(missing_ok=True)
+        raise
+
+    key = digest.hexdigest()
+    # Disk and index writes run in a thread so a slow disk or a compaction pass doesn't stall the bot
+    if spill is not None:
+        spill.close()
+        path = await asyncio.to_thread(receipts.add_file, spill_path, key, size, user_id, name)
+        return IngestedFile(name=name, size=size, path=path, key=key)
+    data = bytes(buffer)
+    await asyncio.to_thread(spill_path.write_bytes, data)
+    path = await asyncio.to_thread(receipts.add_file, spill_path, key, size, user_id, name)
+    return IngestedFile(name=name, size=size, data=data, path=path, key=key)
+
+
+async def fetch_file(user_id, file_info, client, logger) -> Optional[IngestedFile]:
+    file_id = file_info.get("id")
+    file_name = file_info.get("name", f"file_{file_id}")
+
+    try:
+        if (file_info.get("size") or 0) > MAX_FILE_BYTES:
+            raise FileTooLarge(f"{file_name} is {file_info['size']} bytes, limit is {MAX_FILE_BYTES}")
+
+        # Message events usually carry the download URL already; only ask Slack when they don't
+        url_private = file_info.get("url_private")
+        if not url_private:
+            file_response = await client.files_info(file=file_id)
+            url_private = file_response["file"].get("url_private")
+
+        if not url_private:
+            logger.warning(f"No download URL found for file {file_id}")
+            return None
+
+        with telemetry.span("slack_download", file=file_name):
+            ingested = await _stream_to_file(user_id, file_name, url_private)
+        logger.info(f"Downloaded file: {file_name} from {user_id} ({ingested.size} bytes, "
+                    f"{'in memory' if ingested.data is not None else 'on disk only'}, stored as {ingested.key})")
+        return ingested
+
+    except Exception as e:
+        logger.error(f"Error downloading file {file_id}: {str(e)}")
+        return None
+
+
+async def ingest_files(user_id, files, client, logger) -> list:
+    """
+    Download every file of a Slack upload concurrently over the shared HTTP session.
+
+    Returns:
+        List of IngestedFile for the files that downloaded successfully, in upload order
+    """
+    results = await asyncio.gather(*(fetch_file(user_id, file_info, client, logger) for file_info in files))
+    return [ingested for ingested in results if ingested is not None]
@@ -0,0 +1,173 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional
+
+from agents import telemetry
+
+
+class JobQueue:
+    """
+    Bounded queue of background jobs run by a fixed pool of asyncio worker tasks.
+
+    Lets Slack handlers return (and ack) right away while the real work happens later. Jobs carry an ID,
+    and an ID seen recently is dropped, so events Slack re-delivers are only processed once.
+    """
+
+    def __init__(self, workers: int = 8, maxsize: int = 200, dedup_size: int = 1000, put_timeout: float = 1.0):
+        """
+        Args:
+            workers: Number of worker tasks, i.e. max jobs running at once
+            maxsize: Max jobs waiting to run
+            dedup_size: How many recent job IDs are remembered for deduplication
+            put_timeout: Seconds submit() waits for room in a full queue before rejecting the job
+        """
+        self.workers = workers
+        self.dedup_size = dedup_size
+        self.put_timeout = put_timeout
+
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self._recent_ids: "OrderedDict[str, None]" = OrderedDict()
+        self._tasks = []
+
+        self.submitted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+
+    def start(self):
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._work()))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _seen(self, job_id: str) -> bool:
+        if job_id in self._recent_ids:
+            self._recent_ids.move_to_end(job_id)
+            return True
+        self._recent_ids[job_id] = None
+        if len(self._recent_ids) > self.dedup_size:
+            self._recent_ids.popitem(last=False)
+        return False
+
+    async def submit(self, job_id: Optional[str], fn: Callable[..., Awaitable], *args) -> bool:
+        """
+        Queue fn(*args) to run on a worker.
+
+        Args:
+            job_id: Deduplication key, e.g. the Slack event_id. None skips deduplication.
+
+        Returns:
+            True if the job was queued, False if it was a duplicate
+
+        Raises:
+            asyncio.QueueFull: If the queue stayed full for put_timeout
+        """
+        if job_id is not None and self._seen(job_id):
+            self.duplicates += 1
+            return False
+        if not self._tasks:
+            self.start()
+        try:
+            await asyncio.wait_for(self._queue.put((time.perf_counter(), telemetry.current(), fn, args)), timeout=self.put_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            # Let a later re-delivery of the same event try again
+            if job_id is not None:
+                self._recent_ids.pop(job_id, None)
+            raise asyncio.QueueFull()
+        self.submitted += 1
+        return True
+
+    async def _work(self):
+        while True:
+            queued_at, context, fn, args = await self._queue.get()
+            started_at = time.perf_counter()
+            waited = started_at - queued_at
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            try:
+                # Run under the submitter's event ID, so the job's spans are correlated with it
+                with telemetry.bind(**context):
+                    await fn(*args)
+                self.completed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"Job {getattr(fn, '__name__', fn)} failed: {e!r}")
+            finally:
+                ran = time.perf_counter() - started_at
+                self.run_total += ran
+                self.run_max = max(self.run_max, ran)
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        finished = self.completed + self.failed
+        return {
+            "depth": self._queue.qsize(),
+            "workers": len(self._tasks),
+            "submitted": self.submitted,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "failed": self.failed,
+            "wait_avg": self.wait_total / finished if finished else 0.0,
+            "wait_max": self.wait_max,
+            "run_avg": self.run_total / finished if finished else 0.0,
+            "run_max": self.run_max,
+        }
+
+
+class Turn:
+    """
+    A place in one key's line, taken when its event arrives. `async with turn:` waits until every
+    earlier turn of the key has left its block, so the blocks run one at a time, in arrival order.
+    """
+
+    def __init__(self, line: "TurnLine", key: str, previous: Optional[asyncio.Future]):
+        self._line = line
+        self._key = key
+        self._previous = previous
+        self._done = asyncio.get_running_loop().create_future()
+
+    async def __aenter__(self):
+        if self._previous is not None:
+            # Shielded, so cancelling this job doesn't cancel the earlier turn's future
+            await asyncio.shield(self._previous)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+    def release(self):
+        """Let the next turn go. Safe to call more than once, and for a turn that was never entered."""
+        if not self._done.done():
+            self._done.set_result(None)
+            if self._line._tails.get(self._key) is self._done:
+                del self._line._tails[self._key]
+
+
+class TurnLine:
+    """
+    Per-key ordering for jobs that otherwise run concurrently on a JobQueue, e.g. so one user's
+    messages reach their session in the order they were sent even when their downloads take
+    different times.
+    """
+
+    def __init__(self):
+        # Format: {key: future of the key's latest turn}
+        self._tails: Dict[str, asyncio.Future] = {}
+
+    def take(self, key: str) -> Turn:
+        """Join the line for key. Take turns in arrival order, before anything is awaited."""
+        turn = Turn(self, key, self._tails.get(key))
+        self._tails[key] = turn._done
+        return turn
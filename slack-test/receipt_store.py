@@ -0,0 +1,289 @@
+import asyncio
+import hashlib
+import mmap
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Optional, Tuple
+
+# Temp and unindexed files younger than this may still be in the middle of being written
+STALE_AFTER = 3600
+
+
+def map_file(path) -> bytes:
+    """
+    Memory-map a stored file read-only. The result is bytes-like (slicing, len, hashing, base64) and
+    is paged in from the OS cache as it is read rather than copied up front.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        # The mapping stays valid after the file is closed, or even deleted
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _suffix(name: str) -> str:
+    # Kept so stored files still open by extension (e.g. the backfill scan); anything odd is dropped
+    suffix = Path(name).suffix.lower()
+    return suffix if 1 < len(suffix) <= 6 and suffix[1:].isalnum() else ""
+
+
+class ReceiptStore:
+    """
+    Content-addressed, size-capped store for uploaded receipts.
+
+    Files are kept at <root>/objects/ab/cd/<sha256><suffix>, keyed by the SHA-256 of their bytes (the
+    same key as the OCR cache), so identical uploads are stored once and two uploads with the same name
+    never collide. A SQLite index records every upload: user, session, name, size and timestamps.
+
+    A file is only deleted once no open session references it. compact() removes files whose sessions
+    finished more than retention seconds ago, and whenever the store grows past max_bytes, the least
+    recently used of the unreferenced files are evicted first.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS blobs (
+        key TEXT PRIMARY KEY,
+        path TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        created_at REAL NOT NULL,
+        last_access REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS blobs_last_access ON blobs (last_access);
+
+    CREATE TABLE IF NOT EXISTS uploads (
+        key TEXT NOT NULL,
+        session_id TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        name TEXT NOT NULL,
+        uploaded_at REAL NOT NULL,
+        finished_at REAL,
+        PRIMARY KEY (key, session_id)
+    );
+    CREATE INDEX IF NOT EXISTS uploads_session_id ON uploads (session_id, finished_at);
+    CREATE INDEX IF NOT EXISTS uploads_finished_at ON uploads (finished_at);
+    """
+
+    def __init__(self, root="downloads", max_bytes: int = 1024 ** 3, retention: float = 24 * 3600,
+                 compact_interval: float = 600):
+        """
+        Args:
+            root: Directory holding the files and the index
+            max_bytes: Total size the store is kept under, as far as finished sessions allow
+            retention: Seconds a file is kept after the last session using it finished
+            compact_interval: Seconds between compaction runs started by start()
+        """
+        self.root = Path(root)
+        self.objects = self.root / "objects"
+        self.tmp = self.root / "tmp"
+        self.max_bytes = max_bytes
+        self.retention = retention
+        self.compact_interval = compact_interval
+
+        self.tmp.mkdir(parents=True, exist_ok=True)
+        self.objects.mkdir(exist_ok=True)
+        self.db = sqlite3.connect(self.root / "index.sqlite3", check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(self.SCHEMA)
+        self.db.commit()
+        self._lock = threading.Lock()
+        self._compactor = None
+        # Running total of stored bytes, so the quota check on each upload doesn't scan the index
+        self._bytes = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+        self.stored = 0
+        self.deduplicated = 0
+        self.evicted = 0
+        self.compacted = 0
+
+    async def start(self):
+        if self._compactor is None:
+            self._compactor = asyncio.create_task(self._compact_forever())
+
+    async def close(self):
+        if self._compactor is not None:
+            self._compactor.cancel()
+            await asyncio.gather(self._compactor, return_exceptions=True)
+            self._compactor = None
+        self.db.close()
+
+    async def _compact_forever(self):
+        while True:
+            await asyncio.sleep(self.compact_interval)
+            try:
+                await asyncio.to_thread(self.compact)
+            except Exception as e:
+                print(f"Receipt store compaction failed: {e!r}")
+
+    def path_for(self, key: str, name: str = "") -> Path:
+        return self.objects / key[:2] / key[2:4] / f"{key}{_suffix(name)}"
+
+    def temp_path(self) -> Path:
+        """A fresh path in the store's temp directory, on the same filesystem as the stored files."""
+        return self.tmp / uuid.uuid4().hex
+
+    def add_file(self, temp_path, key: str, size: int, user_id: str, name: str,
+                 session_id: Optional[str] = None) -> Path:
+        """
+        Move a fully written temp file into the store, or discard it if the content is already stored.
+
+        Args:
+            key: SHA-256 hex digest of the file's bytes
+            session_id: Session the upload belongs to; defaults to user_id, since sessions are per user
+
+        Returns:
+            Path of the stored file
+        """
+        now = time.time()
+        with self._lock:
+            row = self.db.execute("SELECT path, size FROM blobs WHERE key = ?", (key,)).fetchone()
+            if row is not None and Path(row[0]).exists():
+                Path(temp_path).unlink(missing_ok=True)
+                path = Path(row[0])
+                self.db.execute("UPDATE blobs SET last_access = ? WHERE key = ?", (now, key))
+                self.deduplicated += 1
+            else:
+                path = self.path_for(key, name)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(temp_path, path)
+                self.db.execute("INSERT OR REPLACE INTO blobs (key, path, size, created_at, last_access) "
+                                "VALUES (?, ?, ?, ?, ?)", (key, str(path), size, now, now))
+                self._bytes += size - (row[1] if row is not None else 0)
+                self.stored += 1
+            # A re-upload reopens the file for this session
+            self.db.execute("INSERT OR REPLACE INTO uploads (key, session_id, user_id, name, uploaded_at, finished_at) "
+                            "VALUES (?, ?, ?, ?, ?, NULL)", (key, session_id or user_id, user_id, name, now))
+            self.db.commit()
+        self._evict_over_quota()
+        return path
+
+    def add_bytes(self, data: bytes, user_id: str, name: str, session_id: Optional[str] = None) -> Tuple[str, Path]:
+        """
+        Store an upload held in memory.
+
+        Returns:
+            (key, path) of the stored file
+        """
+        key = hashlib.sha256(data).hexdigest()
+        temp_path = self.temp_path()
+        temp_path.write_bytes(data)
+        return key, self.add_file(temp_path, key, len(data), user_id, name, session_id)
+
+    def finish_session(self, session_id: str) -> int:
+        """
+        Release a finished session's uploads, so compaction can delete them after retention.
+
+        Returns:
+            Number of uploads released
+        """
+        with self._lock:
+            released = self.db.execute("UPDATE uploads SET finished_at = ? WHERE session_id = ? AND finished_at IS NULL",
+                                       (time.time(), session_id)).rowcount
+            self.db.commit()
+        return released
+
+    def _delete(self, key: str, path: str, size: int):
+        """Caller holds the lock and commits."""
+        Path(path).unlink(missing_ok=True)
+        if self.db.execute("DELETE FROM blobs WHERE key = ?", (key,)).rowcount:
+            self._bytes -= size
+        self.db.execute("DELETE FROM uploads WHERE key = ?", (key,))
+
+    def _delete_unreferenced(self, key: str, path: str, size: int, open_only: bool) -> bool:
+        """
+        Delete one file under its own short hold of the lock, unless it gained an upload (an open one, with
+        open_only) since it was picked. Deleting file by file keeps downloads from waiting on a whole pass.
+        """
+        query = "SELECT 1 FROM uploads WHERE key = ?" + (" AND finished_at IS NULL" if open_only else "")
+        with self._lock:
+            if self.db.execute(query, (key,)).fetchone():
+                return False
+            self._delete(key, path, size)
+            self.db.commit()
+        return True
+
+    def _evict_over_quota(self) -> int:
+        """Delete least recently used unreferenced files until the store fits in max_bytes."""
+        if self._bytes <= self.max_bytes:
+            return 0
+        # Least recently uploaded first, among files no open session still needs
+        with self._lock:
+            unreferenced = self.db.execute(
+                "SELECT key, path, size FROM blobs WHERE NOT EXISTS "
+                "(SELECT 1 FROM uploads WHERE uploads.key = blobs.key AND uploads.finished_at IS NULL) "
+                "ORDER BY last_access").fetchall()
+        evicted = 0
+        for key, path, size in unreferenced:
+            if self._bytes <= self.max_bytes:
+                break
+            if self._delete_unreferenced(key, path, size, open_only=True):
+                evicted += 1
+        self.evicted += evicted
+        if self._bytes > self.max_bytes:
+            print(f"Receipt store is {self._bytes} bytes, over its {self.max_bytes} byte limit, "
+                  f"but every remaining file belongs to an open session")
+        return evicted
+
+    def compact(self) -> int:
+        """
+        Delete files whose sessions finished more than retention seconds ago, then evict down to
+        max_bytes. Also clears out temp files left by interrupted downloads, files the index lost
+        track of, and index rows whose file is gone.
+
+        Returns:
+            Number of stored files deleted
+        """
+        now = time.time()
+        with self._lock:
+            self.db.execute("DELETE FROM uploads WHERE finished_at < ?", (now - self.retention,))
+            self.db.commit()
+            orphaned = self.db.execute(
+                "SELECT key, path, size FROM blobs WHERE NOT EXISTS (SELECT 1 FROM uploads WHERE uploads.key = blobs.key)"
+            ).fetchall()
+        # A file uploaded again since the query above is kept
+        removed = sum(self._delete_unreferenced(key, path, size, open_only=False) for key, path, size in orphaned)
+
+        with self._lock:
+            blobs = self.db.execute("SELECT key, path, size FROM blobs").fetchall()
+        indexed = set()
+        for key, path, size in blobs:
+            if Path(path).exists():
+                indexed.add(path)
+            else:
+                with self._lock:
+                    # Re-checked under the lock: a re-upload may have just put the file back
+                    if not Path(path).exists():
+                        self._delete(key, path, size)
+                        self.db.commit()
+        removed += self._evict_over_quota()
+
+        for path in list(self.tmp.iterdir()) + [p for p in self.objects.rglob("*") if p.is_file()]:
+            if str(path) in indexed:
+                continue
+            try:
+                if now - path.stat().st_mtime > STALE_AFTER:
+                    path.unlink()
+            except FileNotFoundError:
+                pass
+        self.compacted += removed
+        if removed:
+            print(f"Receipt store compaction deleted {removed} files")
+        return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            files, size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+            open_uploads = self.db.execute("SELECT COUNT(*) FROM uploads WHERE finished_at IS NULL").fetchone()[0]
+        return {
+            "files": files,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "open_uploads": open_uploads,
+            "stored": self.stored,
+            "deduplicated": self.deduplicated,
+            "evicted": self.evicted,
+            "compacted": self.compacted,
+        }
@@ -1,8 +1,30 @@
+import os
 import sys
+import asyncio
+from collections import OrderedDict, deque
 from pathlib import Path
 import time
-from typing import Dict, Optional
-from agents.main_agent import ReimbursementManager
+from typing import Callable, Dict, List, Optional
+from agents import telemetry
+from agents.main_agent import ReimbursementManager, build_options
+from agents.pool import AgentPool
+from store import SessionStore, SQLiteSessionStore, MemorySessionStore
+
+
+def approx_size(obj, seen=None) -> int:
+    """Rough deep size of obj in bytes, following containers and object attributes."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(approx_size(k, seen) + approx_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(approx_size(item, seen) for item in obj)
+    elif hasattr(obj, "__dict__"):
+        size += approx_size(vars(obj), seen)
+    return size
 
 
 class SessionManager:
@@ -11,11 +33,204 @@ class SessionManager:
     Handles session creation, deletion, message processing, and session listing.
     """
     
-    def __init__(self):
-        """Initialize the ClaudeClient with an empty sessions dictionary."""
-        # Format: {session_id: {"id": str, "created_at": datetime, "manager": ReimbursementManager}}
-        self.sessions: Dict[str, dict] = {}
-    
+    def __init__(self, pool: Optional[AgentPool] = None, idle_ttl: Optional[float] = None,
+                 absolute_ttl: Optional[float] = None, max_sessions: Optional[int] = None,
+                 sweep_interval: float = 60.0, store: Optional[SessionStore] = None,
+                 coalesce_window: Optional[float] = None, purge_store: bool = True):
+        """
+        Initialize the ClaudeClient with an empty sessions dictionary.
+
+        Args:
+            pool: Agent client pool shared by all sessions. Defaults to one sized by AGENT_POOL_SIZE.
+            idle_ttl: Seconds without activity before a session expires. Defaults to SESSION_IDLE_TTL.
+            absolute_ttl: Seconds after creation before a session expires. Defaults to SESSION_ABSOLUTE_TTL.
+            max_sessions: Max live sessions; the least recently used is evicted beyond this.
+                Defaults to SESSION_MAX_COUNT.
+            sweep_interval: Seconds between background expiry sweeps
+            store: Durable store sessions are saved to and lazily loaded from. Defaults to SQLite at
+                SESSION_STORE_PATH, or memory only if that is empty.
+            coalesce_window: Seconds to wait for more DMs from the same user before running a turn, so a
+                burst of messages becomes one agent turn. Defaults to MESSAGE_COALESCE_WINDOW; 0 disables.
+            purge_store: Whether sweeps also purge expired sessions that aren't loaded from the store.
+                When several managers share one store, only one of them should.
+        """
+        # Format: {session_id: {"id": str, "created_at": datetime, "opened_at": float, "last_access": float, "manager": ReimbursementManager}}
+        # Holds the sessions currently in memory, ordered from least to most recently used
+        self.sessions: "OrderedDict[str, dict]" = OrderedDict()
+        self.pool = pool or AgentPool(
+            build_options,
+            size=int(os.getenv("AGENT_POOL_SIZE", "4")),
+            min_idle=int(os.getenv("AGENT_POOL_MIN_IDLE", "1")),
+            max_idle=float(os.getenv("AGENT_POOL_MAX_IDLE", "300")),
+        )
+
+        if store is None:
+            store_path = os.getenv("SESSION_STORE_PATH", "sessions.sqlite3")
+            store = SQLiteSessionStore(store_path) if store_path else MemorySessionStore()
+        self.store = store
+
+        self.idle_ttl = idle_ttl if idle_ttl is not None else float(os.getenv("SESSION_IDLE_TTL", str(24 * 3600)))
+        self.absolute_ttl = absolute_ttl if absolute_ttl is not None else float(os.getenv("SESSION_ABSOLUTE_TTL", str(7 * 24 * 3600)))
+        self.max_sessions = max_sessions if max_sessions is not None else int(os.getenv("SESSION_MAX_COUNT", "1000"))
+        self.sweep_interval = sweep_interval
+        self.purge_store = purge_store
+        self._sweeper = None
+
+        # Called with (user_id, reason) whenever a session is evicted
+        self.eviction_listeners: List[Callable[[str, str], None]] = []
+        self.evictions = {"idle": 0, "expired": 0, "capacity": 0}
+
+        # Per-user inbox of messages waiting for their turn, and the task draining it.
+        # Format: {user_id: deque of (kind, message_content, downloaded_files, future)}
+        self.coalesce_window = coalesce_window if coalesce_window is not None else float(os.getenv("MESSAGE_COALESCE_WINDOW", "0.5"))
+        self._inboxes: Dict[str, deque] = {}
+        self._drainers: Dict[str, asyncio.Task] = {}
+        self.turns_processed = 0
+        self.messages_coalesced = 0
+
+    async def start(self):
+        """Pre-warm the agent pool and start the expiry sweeper. Call once the event loop is running."""
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_forever())
+        await self.store.start()
+        await self.pool.start()
+
+    async def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        for session_id in self.sessions:
+            self._persist(session_id)
+        await self.store.close()
+        await self.pool.close()
+
+    async def _sweep_forever(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self.sweep()
+
+    def _expiry_reason(self, session: dict, now: float) -> Optional[str]:
+        if now - session["last_access"] > self.idle_ttl:
+            return "idle"
+        if now - session["opened_at"] > self.absolute_ttl:
+            return "expired"
+        return None
+
+    def _persist(self, session_id: str, session: Optional[dict] = None):
+        session = session or self.sessions[session_id]
+        if session.get("closed"):
+            # Deleted or expired while its turn ran; saving it would bring it back
+            return
+        state = session["manager"].to_state()
+        state["opened_at"] = session["opened_at"]
+        state["updated_at"] = session["last_access"]
+        self.store.save_session(session_id, state)
+
+    def _evict(self, session_id: str, reason: str):
+        self.evictions[reason] += 1
+        print(f"Evicted session {session_id} ({reason})")
+        if reason == "capacity":
+            # Only unloaded from memory; it is hydrated again from the store on next access
+            self._persist(session_id)
+            del self.sessions[session_id]
+            return
+
+        self._close(session_id)
+        self._notify_evicted(session_id, reason)
+
+    def _close(self, session_id: str):
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            session["closed"] = True
+        self.store.delete_session(session_id)
+
+    def _notify_evicted(self, session_id: str, reason: str):
+        for listener in self.eviction_listeners:
+            try:
+                listener(session_id, reason)
+            except Exception as e:
+                print(f"Eviction listener failed for {session_id}: {e!r}")
+
+    def sweep(self) -> int:
+        """
+        Evict every expired session, in memory and in the store.
+
+        Returns:
+            Number of sessions evicted
+        """
+        now = time.time()
+        expired = [(session_id, reason) for session_id, session in self.sessions.items()
+                   if (reason := self._expiry_reason(session, now))]
+        for session_id, reason in expired:
+            self._evict(session_id, reason)
+
+        if not self.purge_store:
+            return len(expired)
+        # Sessions that aren't loaded can only expire through the store
+        for session_id in self.store.purge_expired(self.idle_ttl, self.absolute_ttl):
+            self.evictions["expired"] += 1
+            self._notify_evicted(session_id, "expired")
+        return len(expired)
+
+    def _hydrate(self, user_id: str) -> Optional[dict]:
+        state = self.store.load_session(user_id)
+        if state is None:
+            return None
+        manager = ReimbursementManager.from_state(user_id, state, pool=self.pool)
+        self._make_room()
+        self.sessions[user_id] = {
+            "id": user_id,
+            "created_at": state["opened_at"],
+            "opened_at": state["opened_at"],
+            "last_access": state["updated_at"],
+            "manager": manager,
+        }
+        return self.sessions[user_id]
+
+    def _make_room(self):
+        # Unload the least recently used sessions to stay under max_sessions. Sessions with a turn queued
+        # or running stay loaded, so the count can go over max_sessions until those turns finish.
+        idle = [session_id for session_id in self.sessions if session_id not in self._drainers]
+        for session_id in idle[:max(0, len(self.sessions) - self.max_sessions + 1)]:
+            self._evict(session_id, "capacity")
+
+    def _get_session(self, user_id: str) -> Optional[dict]:
+        """
+        Look up a session, loading it from the store if it isn't in memory.
+        Expires it on the spot if it's past its TTL, otherwise marks it as used.
+        """
+        session = self.sessions.get(user_id) or self._hydrate(user_id)
+        if session is None:
+            return None
+        now = time.time()
+        reason = self._expiry_reason(session, now)
+        if reason:
+            self._evict(user_id, reason)
+            return None
+        session["last_access"] = now
+        self.sessions.move_to_end(user_id)
+        return session
+
+    def unload(self, user_ids) -> int:
+        """
+        Persist sessions and drop them from memory, e.g. when another process takes over these users.
+        Unlike eviction, the stored sessions are kept.
+
+        Returns:
+            Number of sessions unloaded
+        """
+        unloaded = 0
+        for user_id in user_ids:
+            if user_id in self.sessions:
+                self._persist(user_id)
+                del self.sessions[user_id]
+                unloaded += 1
+        self.store.flush()
+        return unloaded
+
+    def has_session(self, user_id: str) -> bool:
+        return self._get_session(user_id) is not None
+
     def create_session(self, user_id: str, start_time: int) -> dict:
         """
         Create a new session with a reimbursement manager.
@@ -33,21 +248,27 @@ class SessionManager:
         session_id = user_id
         
         # Check if session already exists
-        if session_id in self.sessions:
+        if self.has_session(session_id):
             raise ValueError(f"Session with ID '{session_id}' already exists")
         
         # Use provided start_time or current time
         created_at = start_time if start_time is not None else time.perf_counter()
         
         # Create a new ReimbursementManager instance for this session
-        manager = ReimbursementManager(session_id)
+        manager = ReimbursementManager(session_id, pool=self.pool)
         
+        self._make_room()
+
         # Store the session
+        now = time.time()
         self.sessions[session_id] = {
             "id": session_id,
             "created_at": created_at,
+            "opened_at": now,
+            "last_access": now,
             "manager" : manager
         }
+        self._persist(session_id)
         
         return {
             "session_id": session_id,
@@ -69,31 +290,126 @@ class SessionManager:
         """
         session_id = user_id
         
-        if session_id not in self.sessions:
+        if not self.has_session(session_id):
             raise ValueError(f"Session with ID '{session_id}' not found")
         
         # Clean up the session
         # Note: If the manager has any cleanup needed, it should be done here
-        del self.sessions[session_id]
+        self._close(session_id)
         
         return {"message": f"Session {session_id} closed successfully"}
     
     def get_sessions(self) -> dict:
         """
-        Fetch all active sessions.
+        Fetch all sessions currently loaded in memory.
         
         Returns:
             dict with list of sessions containing session_id and created_at
         """
         return {id : {"start_time": self.sessions[id]["created_at"]} for id in self.sessions.keys()}
     
-    async def new_dm_message(self, user_id: str, message_content: str, downloaded_file_names) -> dict:
-        manager = self.sessions[user_id]["manager"]
-        print("manger: ", manager)
-        all_info_gathered, response = await manager.process_user_message(message_content, downloaded_file_names)
-        return response
+    def stats(self) -> dict:
+        """Live session count, evictions by reason, queue counters and approximate memory held per session."""
+        # The pool and agent client are shared or external, so they aren't counted against the session
+        sizes = [approx_size({k: v for k, v in vars(session["manager"]).items() if k not in ("pool", "agent")})
+                 for session in self.sessions.values()]
+        return {
+            "live_sessions": len(self.sessions),
+            "evictions": dict(self.evictions),
+            "queued_messages": sum(len(inbox) for inbox in self._inboxes.values()),
+            "turns_processed": self.turns_processed,
+            "messages_coalesced": self.messages_coalesced,
+            "approx_bytes_total": sum(sizes),
+            "approx_bytes_per_session": sum(sizes) / len(sizes) if sizes else 0,
+        }
+
+    def _submit(self, user_id: str, kind: str, message_content: str, downloaded_files=None,
+                on_text: Optional[Callable[[str], None]] = None) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._inboxes.setdefault(user_id, deque()).append(
+            (kind, message_content, list(downloaded_files or []), on_text, telemetry.current(), future))
+        if user_id not in self._drainers:
+            self._drainers[user_id] = asyncio.create_task(self._drain(user_id))
+        return future
+
+    async def _drain(self, user_id: str):
+        """Run one user's queued messages one turn at a time, merging bursts of DMs into a single turn."""
+        inbox = self._inboxes[user_id]
+        try:
+            while inbox:
+                kind, message_content, downloaded_files, on_text, context, future = inbox.popleft()
+                futures = [future]
+                if kind == "dm" and self.coalesce_window > 0:
+                    await asyncio.sleep(self.coalesce_window)
+                    while inbox and inbox[0][0] == "dm":
+                        _, more_content, more_files, on_text, context, more_future = inbox.popleft()
+                        message_content = "\n".join(text for text in (message_content, more_content) if text)
+                        downloaded_files += more_files
+                        futures.append(more_future)
+                        self.messages_coalesced += 1
+
+                try:
+                    # Spans of the turn are logged against the event that gets the reply
+                    with telemetry.bind(**context):
+                        if kind == "dm":
+                            response = await self._process_dm(user_id, message_content, downloaded_files, on_text)
+                        else:
+                            response = await self._process_thread(user_id, message_content)
+                except Exception as e:
+                    for pending in futures:
+                        pending.set_exception(e)
+                    continue
+                self.turns_processed += 1
+                # Only the latest message of a burst gets the reply
+                for pending in futures[:-1]:
+                    pending.set_result(None)
+                futures[-1].set_result(response)
+        finally:
+            del self._drainers[user_id]
+            del self._inboxes[user_id]
+
+    async def new_dm_message(self, user_id: str, message_content: str, downloaded_files,
+                             on_text: Optional[Callable[[str], None]] = None) -> Optional[dict]:
+        """
+        Queue a DM for the user's session, creating the session if needed, and wait for its reply.
+
+        Args:
+            on_text: Called with the partial reply while it is generated. For a merged burst, the
+                callback of the latest message is used, since that message carries the reply.
+
+        Returns:
+            The response for the turn, or None if this message was merged into a later one that carries the reply
+        """
+        return await self._submit(user_id, "dm", message_content, downloaded_files, on_text)
+
+    async def queue_dm_message(self, user_id: str, message_content: str, downloaded_files,
+                               on_text: Optional[Callable[[str], None]] = None) -> asyncio.Future:
+        """
+        Like new_dm_message, but returns once the message is in the user's inbox.
+
+        Returns:
+            Future of the reply new_dm_message would have returned
+        """
+        return self._submit(user_id, "dm", message_content, downloaded_files, on_text)
 
     async def new_thread_message(self, user_id: str, message_content: str) -> dict:
-        manager = self.sessions[user_id]["manager"]
-        response = await manager.read_response(message_content)
-        return response
\ No newline at end of file
+        """Queue a reply from the user's approval thread and wait for the verdict."""
+        return await self._submit(user_id, "thread", message_content)
+
+    async def _process_dm(self, user_id: str, message_content: str, downloaded_files,
+                          on_text: Optional[Callable[[str], None]] = None) -> dict:
+        session = self._get_session(user_id)
+        if session is None:
+            self.create_session(user_id, time.perf_counter())
+            session = self.sessions[user_id]
+        manager = session["manager"]
+        all_info_gathered, response = await manager.process_user_message(message_content, downloaded_files, on_text)
+        # The session held by this turn, even if it was unloaded meanwhile
+        self._persist(user_id, session)
+        return response
+
+    async def _process_thread(self, user_id: str, message_content: str) -> dict:
+        session = self._get_session(user_id)
+        response = await session["manager"].read_response(message_content)
+        self._persist(user_id, session)
+        return response
@@ -0,0 +1,322 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections.abc import MutableMapping
+from typing import Dict, List, Optional
+
+
+class SessionStore:
+    """
+    Durable storage for sessions and watched approval threads.
+
+    A session state is the dict produced by ReimbursementManager.to_state(). Implementations may
+    buffer writes, but reads must always see the latest write.
+    """
+
+    def load_session(self, user_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def save_session(self, user_id: str, state: dict):
+        raise NotImplementedError
+
+    def delete_session(self, user_id: str):
+        raise NotImplementedError
+
+    def purge_expired(self, idle_ttl: float, absolute_ttl: float) -> List[str]:
+        """Delete stored sessions past either TTL and return their user IDs."""
+        raise NotImplementedError
+
+    def get_watched_user(self, thread_ts: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def watch_thread(self, thread_ts: str, user_id: str):
+        raise NotImplementedError
+
+    def unwatch_thread(self, thread_ts: str):
+        raise NotImplementedError
+
+    def watched_threads_for(self, user_id: str) -> List[str]:
+        raise NotImplementedError
+
+    def flush(self):
+        """Write any buffered changes out now."""
+        pass
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    """Keeps everything in process memory. State is lost on restart."""
+
+    def __init__(self):
+        self.sessions: Dict[str, dict] = {}
+        self.watched: Dict[str, str] = {}
+
+    def load_session(self, user_id: str) -> Optional[dict]:
+        return self.sessions.get(user_id)
+
+    def save_session(self, user_id: str, state: dict):
+        self.sessions[user_id] = state
+
+    def delete_session(self, user_id: str):
+        self.sessions.pop(user_id, None)
+        for thread_ts in self.watched_threads_for(user_id):
+            del self.watched[thread_ts]
+
+    def purge_expired(self, idle_ttl: float, absolute_ttl: float) -> List[str]:
+        now = time.time()
+        expired = [user_id for user_id, state in self.sessions.items()
+                   if now - state["updated_at"] > idle_ttl or now - state["opened_at"] > absolute_ttl]
+        for user_id in expired:
+            self.delete_session(user_id)
+        return expired
+
+    def get_watched_user(self, thread_ts: str) -> Optional[str]:
+        return self.watched.get(thread_ts)
+
+    def watch_thread(self, thread_ts: str, user_id: str):
+        self.watched[thread_ts] = user_id
+
+    def unwatch_thread(self, thread_ts: str):
+        self.watched.pop(thread_ts, None)
+
+    def watched_threads_for(self, user_id: str) -> List[str]:
+        return [thread_ts for thread_ts, watched_user in self.watched.items() if watched_user == user_id]
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    SQLite-backed store. Nothing is loaded at startup; sessions are read on demand.
+
+    Writes are buffered and flushed in one transaction every flush_interval seconds, or as soon as
+    batch_size writes are pending. Repeated saves of the same session between flushes collapse into one.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sessions (
+        user_id TEXT PRIMARY KEY,
+        opened_at REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        state TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at);
+    CREATE INDEX IF NOT EXISTS sessions_opened_at ON sessions (opened_at);
+
+    CREATE TABLE IF NOT EXISTS receipts (
+        user_id TEXT PRIMARY KEY,
+        data TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS turns (
+        user_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        text TEXT NOT NULL,
+        PRIMARY KEY (user_id, seq)
+    );
+
+    CREATE TABLE IF NOT EXISTS watched_threads (
+        thread_ts TEXT PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        created_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS watched_threads_user_id ON watched_threads (user_id);
+    """
+
+    def __init__(self, path: str = "sessions.sqlite3", flush_interval: float = 0.5, batch_size: int = 100):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        self.db.commit()
+        self._lock = threading.Lock()
+
+        # Pending writes, keyed so later writes to the same row replace earlier ones.
+        # A value of None means delete.
+        self._pending_sessions: Dict[str, Optional[dict]] = {}
+        self._pending_threads: Dict[str, Optional[tuple]] = {}
+        self._flusher = None
+        self._wakeup = None
+
+    def _pending_count(self) -> int:
+        return len(self._pending_sessions) + len(self._pending_threads)
+
+    def _written(self):
+        if self._wakeup is not None and self._pending_count() >= self.batch_size:
+            self._wakeup.set()
+
+    # Sessions
+
+    def load_session(self, user_id: str) -> Optional[dict]:
+        if user_id in self._pending_sessions:
+            return self._pending_sessions[user_id]
+        with self._lock:
+            row = self.db.execute("SELECT state FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None:
+                return None
+            receipt = self.db.execute("SELECT data FROM receipts WHERE user_id = ?", (user_id,)).fetchone()
+            turns = self.db.execute(
+                "SELECT role, text FROM turns WHERE user_id = ? ORDER BY seq", (user_id,)).fetchall()
+        state = json.loads(row[0])
+        state["receipt"] = json.loads(receipt[0]) if receipt else None
+        state["memory"]["turns"] = [{"role": role, "text": text} for role, text in turns]
+        return state
+
+    def save_session(self, user_id: str, state: dict):
+        self._pending_sessions[user_id] = state
+        self._written()
+
+    def delete_session(self, user_id: str):
+        self._pending_sessions[user_id] = None
+        for thread_ts in self.watched_threads_for(user_id):
+            self._pending_threads[thread_ts] = None
+        self._written()
+
+    def purge_expired(self, idle_ttl: float, absolute_ttl: float) -> List[str]:
+        now = time.time()
+        self.flush()
+        with self._lock:
+            expired = [row[0] for row in self.db.execute(
+                "SELECT user_id FROM sessions WHERE updated_at < ? OR opened_at < ?",
+                (now - idle_ttl, now - absolute_ttl))]
+        for user_id in expired:
+            self.delete_session(user_id)
+        return expired
+
+    # Watched threads
+
+    def get_watched_user(self, thread_ts: str) -> Optional[str]:
+        if thread_ts in self._pending_threads:
+            pending = self._pending_threads[thread_ts]
+            return pending[0] if pending else None
+        with self._lock:
+            row = self.db.execute("SELECT user_id FROM watched_threads WHERE thread_ts = ?", (thread_ts,)).fetchone()
+        return row[0] if row else None
+
+    def watch_thread(self, thread_ts: str, user_id: str):
+        self._pending_threads[thread_ts] = (user_id, time.time())
+        self._written()
+
+    def unwatch_thread(self, thread_ts: str):
+        self._pending_threads[thread_ts] = None
+        self._written()
+
+    def watched_threads_for(self, user_id: str) -> List[str]:
+        with self._lock:
+            stored = {row[0] for row in self.db.execute(
+                "SELECT thread_ts FROM watched_threads WHERE user_id = ?", (user_id,))}
+        for thread_ts, pending in self._pending_threads.items():
+            if pending and pending[0] == user_id:
+                stored.add(thread_ts)
+            elif pending is None:
+                stored.discard(thread_ts)
+        return sorted(stored)
+
+    # Flushing
+
+    def flush(self):
+        """Write every pending change in a single transaction."""
+        sessions, self._pending_sessions = self._pending_sessions, {}
+        threads, self._pending_threads = self._pending_threads, {}
+        if not sessions and not threads:
+            return
+
+        upserts, receipts, turns = [], [], []
+        for user_id, state in sessions.items():
+            if state is None:
+                continue
+            state = dict(state)
+            receipt = state.pop("receipt", None)
+            memory = dict(state["memory"])
+            state["memory"] = memory
+            session_turns = memory.pop("turns", [])
+            upserts.append((user_id, state["opened_at"], state["updated_at"], json.dumps(state)))
+            if receipt is not None:
+                receipts.append((user_id, json.dumps(receipt)))
+            turns.extend((user_id, seq, turn["role"], turn["text"]) for seq, turn in enumerate(session_turns))
+        touched = [(user_id,) for user_id in sessions]
+
+        with self._lock, self.db:
+            # Turns and receipts are rewritten wholesale for every touched session
+            self.db.executemany("DELETE FROM turns WHERE user_id = ?", touched)
+            self.db.executemany("DELETE FROM receipts WHERE user_id = ?", touched)
+            self.db.executemany("DELETE FROM sessions WHERE user_id = ?",
+                                [(user_id,) for user_id, state in sessions.items() if state is None])
+            self.db.executemany(
+                "INSERT OR REPLACE INTO sessions (user_id, opened_at, updated_at, state) VALUES (?, ?, ?, ?)",
+                upserts)
+            self.db.executemany("INSERT INTO receipts (user_id, data) VALUES (?, ?)", receipts)
+            self.db.executemany("INSERT INTO turns (user_id, seq, role, text) VALUES (?, ?, ?, ?)", turns)
+            self.db.executemany("DELETE FROM watched_threads WHERE thread_ts = ?",
+                                [(thread_ts,) for thread_ts, pending in threads.items() if pending is None])
+            self.db.executemany(
+                "INSERT OR REPLACE INTO watched_threads (thread_ts, user_id, created_at) VALUES (?, ?, ?)",
+                [(thread_ts, pending[0], pending[1]) for thread_ts, pending in threads.items() if pending])
+
+    async def _flush_forever(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Failed to flush session store: {e!r}")
+
+    async def start(self):
+        if self._flusher is None:
+            self._wakeup = asyncio.Event()
+            self._flusher = asyncio.create_task(self._flush_forever())
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        self.flush()
+        self.db.close()
+
+
+class WatchedThreads(MutableMapping):
+    """
+    thread_ts -> user_id mapping for approval threads, backed by a SessionStore.
+    Lookups go to the store on demand, so nothing needs loading at startup.
+    """
+
+    def __init__(self, store: SessionStore):
+        self.store = store
+
+    def __getitem__(self, thread_ts):
+        user_id = self.store.get_watched_user(thread_ts)
+        if user_id is None:
+            raise KeyError(thread_ts)
+        return user_id
+
+    def __contains__(self, thread_ts):
+        return self.store.get_watched_user(thread_ts) is not None
+
+    def __setitem__(self, thread_ts, user_id):
+        self.store.watch_thread(thread_ts, user_id)
+
+    def __delitem__(self, thread_ts):
+        self.store.unwatch_thread(thread_ts)
+
+    def __iter__(self):
+        raise TypeError("Watched threads are not enumerable; use threads_for(user_id)")
+
+    def __len__(self):
+        raise TypeError("Watched threads are not enumerable; use threads_for(user_id)")
+
+    def threads_for(self, user_id: str) -> List[str]:
+        return self.store.watched_threads_for(user_id)
@@ -0,0 +1,77 @@
+import asyncio
+import time
+from typing import Optional
+
+
+class SlackStreamer:
+    """
+    Delivers a reply progressively: the first partial text is posted as a new message, which is then
+    edited with chat_update as more text arrives. Edits are throttled to one per min_interval seconds
+    to stay inside Slack's rate limits, and only the latest text is ever sent.
+
+    If nothing was streamed, or posting failed, finish() returns False so the caller can fall back
+    to sending the reply in one piece.
+    """
+
+    def __init__(self, client, channel: str, min_interval: float = 1.0, logger=None):
+        self.client = client
+        self.channel = channel
+        self.min_interval = min_interval
+        self.logger = logger
+
+        self.ts: Optional[str] = None
+        self.failed = False
+        self._latest = ""
+        self._sent = ""
+        self._last_sent_at = 0.0
+        self._flusher: Optional[asyncio.Task] = None
+
+    def update(self, text: str):
+        """Record the reply so far. Returns immediately; sending happens in the background."""
+        if self.failed or not text.strip():
+            return
+        self._latest = text
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush())
+
+    async def _send(self, text: str):
+        if self.ts is None:
+            message = await self.client.chat_postMessage(channel=self.channel, text=text)
+            self.ts = message["ts"]
+        else:
+            await self.client.chat_update(channel=self.channel, ts=self.ts, text=text)
+        self._sent = text
+        self._last_sent_at = time.monotonic()
+
+    async def _flush(self):
+        try:
+            while self._latest != self._sent:
+                wait = self._last_sent_at + self.min_interval - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                await self._send(self._latest)
+        except Exception as e:
+            self.failed = self.ts is None
+            if self.logger:
+                self.logger.warning(f"Streaming update failed: {str(e)}")
+
+    async def finish(self, text: str) -> bool:
+        """
+        Replace the streamed message with the final text.
+
+        Returns:
+            True if the reply was delivered through the streamed message, False if the caller still
+            needs to send it
+        """
+        if self._flusher is not None:
+            await self._flusher
+        if self.ts is None:
+            return False
+        try:
+            if text != self._sent:
+                await self.client.chat_update(channel=self.channel, ts=self.ts, text=text)
+            return True
+        except Exception as e:
+            if self.logger:
+                self.logger.warning(f"Failed to finish streamed message: {str(e)}")
+            return False
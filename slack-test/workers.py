@@ -0,0 +1,322 @@
+"""
+Multi-process worker mode.
+
+The Socket Mode process keeps all Slack I/O and hands each session turn to one of N worker processes,
+chosen by consistent hash of the user ID. Each worker runs its own SessionManager (and agent pool)
+over the shared SQLite session store, so sessions move between workers by being unloaded by one and
+hydrated by the other.
+"""
+import asyncio
+import bisect
+import hashlib
+import itertools
+import multiprocessing
+import os
+import threading
+from typing import Callable, Dict, List, Optional
+
+from agents import telemetry
+from session_manager import SessionManager
+from store import SessionStore, SQLiteSessionStore
+
+# Seconds between checks that every worker process is still running
+WORKER_WATCHDOG_INTERVAL = float(os.getenv("WORKER_WATCHDOG_INTERVAL", "5"))
+
+
+class HashRing:
+    """
+    Consistent hash of keys onto shards 0..count-1. Changing the count only moves about 1/count of
+    the keys. Uses MD5 rather than hash() so every process agrees on the mapping.
+    """
+
+    def __init__(self, count: int, replicas: int = 100):
+        self.count = count
+        points = sorted((self._hash(f"{shard}:{replica}"), shard)
+                        for shard in range(count) for replica in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def shard_for(self, key: str) -> int:
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._shards[index]
+
+
+def run_worker(index: int, count: int, requests, responses):
+    """Entry point of a worker process: serve session requests until a None request arrives."""
+    asyncio.run(_serve(index, count, requests, responses))
+
+
+async def _serve(index: int, count: int, requests, responses):
+    # The store is shared, so only the first worker purges expired sessions nobody has loaded
+    manager = SessionManager(purge_store=index == 0)
+    manager.eviction_listeners.append(lambda user_id, reason: responses.put((None, "evicted", (user_id, reason))))
+    ring = HashRing(count)
+    await manager.start()
+    print(f"Worker {index}/{count} started (pid {os.getpid()})")
+
+    async def handle(request_id, op, args):
+        nonlocal ring
+        try:
+            if op == "dm":
+                user_id, message_content, downloaded_files = args
+                on_text = lambda text: responses.put((request_id, "text", text))
+                result = await manager.new_dm_message(user_id, message_content, downloaded_files, on_text)
+            elif op == "thread":
+                result = await manager.new_thread_message(*args)
+            elif op == "delete":
+                result = manager.delete_session(*args)
+            elif op == "rebalance":
+                ring = HashRing(args[0])
+                result = manager.unload([user_id for user_id in list(manager.sessions)
+                                         if ring.shard_for(user_id) != index])
+            elif op == "stats":
+                result = manager.stats()
+            else:
+                raise ValueError(f"Unknown worker request {op}")
+            responses.put((request_id, "result", result))
+        except Exception as e:
+            # Exceptions are re-raised in the front process, so send something that always pickles
+            responses.put((request_id, "error", RuntimeError(f"{op} failed in worker {index}: {e!r}")))
+
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    try:
+        while True:
+            request = await loop.run_in_executor(None, requests.get)
+            if request is None:
+                break
+            request_id, op, args, context = request
+            # Tasks start in arrival order, so each user's messages reach the session inbox in order.
+            # Each task copies the front process's user and event IDs for its spans.
+            with telemetry.bind(**context):
+                task = asyncio.create_task(handle(request_id, op, args))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await manager.close()
+        print(f"Worker {index} stopped")
+
+
+class ShardedSessionManager:
+    """
+    Front-process stand-in for SessionManager that routes every turn to the worker owning the user.
+
+    Each worker runs one user's turns in order, exactly like a single SessionManager. resize() changes
+    the worker count while running: it holds new turns, lets the ones in flight finish, has every
+    worker unload the sessions it no longer owns, then resumes on the new ring.
+
+    A watchdog checks the workers every WORKER_WATCHDOG_INTERVAL seconds. When one has exited, the
+    requests it had are failed, so their callers get an error instead of waiting forever, and a new
+    worker is started for its shard.
+    """
+
+    def __init__(self, workers: int, store: Optional[SessionStore] = None):
+        """
+        Args:
+            workers: Number of worker processes
+            store: Store the front process reads watched threads and session existence from. Defaults to
+                SQLite at SESSION_STORE_PATH, which the workers share.
+
+        Raises:
+            ValueError: If SESSION_STORE_PATH is empty; workers can only share sessions through SQLite
+        """
+        if store is None:
+            store_path = os.getenv("SESSION_STORE_PATH", "sessions.sqlite3")
+            if not store_path:
+                raise ValueError("Worker processes share sessions through SQLite; set SESSION_STORE_PATH")
+            store = SQLiteSessionStore(store_path)
+        self.store = store
+        self.ring = HashRing(workers)
+
+        # Called with (user_id, reason) whenever a worker evicts a session
+        self.eviction_listeners: List[Callable[[str, str], None]] = []
+
+        self._context = multiprocessing.get_context("spawn")
+        self._responses = self._context.Queue()
+        self._workers: List[tuple] = []
+        self._reader: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._ids = itertools.count()
+        self._watchdog: Optional[asyncio.Task] = None
+        # Format: {request_id: (future, on_text, shard)}
+        self._pending: Dict[int, tuple] = {}
+        self._resumed = asyncio.Event()
+        self._idle = asyncio.Event()
+        # Fire-and-forget requests, kept referenced until they finish
+        self._background = set()
+
+        self.routed = [0] * workers
+        self.rebalanced_sessions = 0
+        self.restarts = 0
+
+    def _spawn(self, index: int, count: int) -> tuple:
+        requests = self._context.Queue()
+        process = self._context.Process(target=run_worker, args=(index, count, requests, self._responses),
+                                        name=f"session-worker-{index}", daemon=True)
+        process.start()
+        return process, requests
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        await self.store.start()
+        self._workers = [self._spawn(index, self.ring.count) for index in range(self.ring.count)]
+        self._reader = threading.Thread(target=self._read_responses, name="worker-responses", daemon=True)
+        self._reader.start()
+        self._watchdog = asyncio.create_task(self._watch_workers())
+        self._idle.set()
+        self._resumed.set()
+
+    async def close(self):
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+        await self._stop_workers(0)
+        self._responses.put(None)
+        await self.store.close()
+
+    async def _stop_workers(self, keep: int):
+        stopping, self._workers = self._workers[keep:], self._workers[:keep]
+        for _, requests in stopping:
+            requests.put(None)
+        for process, _ in stopping:
+            await self._loop.run_in_executor(None, process.join)
+
+    async def _watch_workers(self):
+        while True:
+            await asyncio.sleep(WORKER_WATCHDOG_INTERVAL)
+            for index, (process, _) in enumerate(self._workers):
+                if process.is_alive():
+                    continue
+                print(f"Worker {index} exited with code {process.exitcode}, restarting it")
+                error = RuntimeError(f"Worker {index} exited with code {process.exitcode}")
+                for request_id in [request_id for request_id, (_, _, shard) in self._pending.items() if shard == index]:
+                    self._settle(request_id, "error", error)
+                self._workers[index] = self._spawn(index, len(self._workers))
+                self.restarts += 1
+
+    def _read_responses(self):
+        while True:
+            message = self._responses.get()
+            if message is None:
+                return
+            self._loop.call_soon_threadsafe(self._dispatch, *message)
+
+    def _dispatch(self, request_id, kind, payload):
+        if kind == "evicted":
+            for listener in self.eviction_listeners:
+                try:
+                    listener(*payload)
+                except Exception as e:
+                    print(f"Eviction listener failed for {payload[0]}: {e!r}")
+            return
+        if request_id not in self._pending:
+            if kind == "error":
+                print(payload)
+            return
+        future, on_text, _ = self._pending[request_id]
+        if kind == "text":
+            if on_text:
+                on_text(payload)
+            return
+        self._settle(request_id, kind, payload)
+
+    def _settle(self, request_id, kind, payload):
+        future, _, _ = self._pending.pop(request_id)
+        if not self._pending:
+            self._idle.set()
+        if future.cancelled():
+            return
+        if kind == "error":
+            future.set_exception(payload)
+        else:
+            future.set_result(payload)
+
+    def _send_to(self, shard: int, op: str, args: tuple, on_text=None) -> asyncio.Future:
+        request_id = next(self._ids)
+        future = self._loop.create_future()
+        # Registered only once the request is sent, so a failed put can't leave resize() waiting on it
+        self._workers[shard][1].put((request_id, op, args, telemetry.current()))
+        self._pending[request_id] = (future, on_text, shard)
+        self._idle.clear()
+        return future
+
+    def _send(self, user_id: str, op: str, args: tuple, on_text=None) -> asyncio.Future:
+        shard = self.ring.shard_for(user_id)
+        self.routed[shard] += 1
+        return self._send_to(shard, op, args, on_text)
+
+    async def _queue(self, user_id: str, op: str, args: tuple, on_text=None) -> asyncio.Future:
+        # Held while a resize is moving sessions between workers
+        await self._resumed.wait()
+        return self._send(user_id, op, args, on_text)
+
+    async def _request(self, user_id: str, op: str, args: tuple, on_text=None):
+        return await (await self._queue(user_id, op, args, on_text))
+
+    async def new_dm_message(self, user_id: str, message_content: str, downloaded_files,
+                             on_text: Optional[Callable[[str], None]] = None) -> Optional[dict]:
+        """Same contract as SessionManager.new_dm_message, run on the user's worker."""
+        return await self._request(user_id, "dm", (user_id, message_content, list(downloaded_files or [])), on_text)
+
+    async def queue_dm_message(self, user_id: str, message_content: str, downloaded_files,
+                               on_text: Optional[Callable[[str], None]] = None) -> asyncio.Future:
+        """Same contract as SessionManager.queue_dm_message; the worker keeps the order messages are sent in."""
+        return await self._queue(user_id, "dm", (user_id, message_content, list(downloaded_files or [])), on_text)
+
+    async def new_thread_message(self, user_id: str, message_content: str) -> dict:
+        return await self._request(user_id, "thread", (user_id, message_content))
+
+    def has_session(self, user_id: str) -> bool:
+        """Checked against the shared store, which sees worker writes within one store flush interval."""
+        return self.store.load_session(user_id) is not None
+
+    def delete_session(self, user_id: str):
+        """Ask the owning worker to delete the session, without waiting for it. Held during a resize like any request."""
+        task = self._loop.create_task(self._request(user_id, "delete", (user_id,)))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())
+
+    async def resize(self, workers: int) -> int:
+        """
+        Change the number of worker processes.
+
+        Returns:
+            Number of sessions unloaded from a worker that no longer owns them
+        """
+        if workers < 1:
+            raise ValueError("At least one worker is required")
+        self._resumed.clear()
+        try:
+            await self._idle.wait()
+            futures = [self._send_to(index, "rebalance", (workers,)) for index in range(len(self._workers))]
+            moved = sum(await asyncio.gather(*futures))
+            await self._stop_workers(workers)
+            for index in range(len(self._workers), workers):
+                self._workers.append(self._spawn(index, workers))
+            self.ring = HashRing(workers)
+            self.routed = (self.routed + [0] * workers)[:workers]
+            self.rebalanced_sessions += moved
+            print(f"Resized to {workers} workers, {moved} sessions moved")
+            return moved
+        finally:
+            self._resumed.set()
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self._workers),
+            "alive": sum(process.is_alive() for process, _ in self._workers),
+            "in_flight": len(self._pending),
+            "restarts": self.restarts,
+            "routed": list(self.routed),
+            "rebalanced_sessions": self.rebalanced_sessions,
+        }
+
+    async def worker_stats(self) -> List[dict]:
+        """SessionManager.stats() of every worker."""
+        return list(await asyncio.gather(*[self._send_to(index, "stats", ()) for index in range(len(self._workers))]))